@@ -0,0 +1,149 @@
+"""
+AsyncServer is an asyncio version of the centralized blockchain server
+
+Every client connection is served by its own coroutine. Transfers are handed to
+a single writer task which applies them to the ledger in arrival order and seals
+them into blocks as the mempool thresholds are reached, while
+balance queries are answered straight away from the snapshot the writer
+publishes after each batch, so a slow client never holds up the others.
+Requests on one connection are pipelined: each is handled in its own task and
+answered as soon as it is done, replies are matched to requests by id.
+"""
+
+import asyncio
+import logging
+import time
+import protocol
+from ledger import Ledger, open_ledger, read_balance, Snapshot
+from mempool import Mempool
+from simple_socket import FRAME_HEADER
+
+CONFIG_FILE = 'config.cfg'
+
+async def read_frame(reader):
+    header = await reader.readexactly(FRAME_HEADER.size)
+    (length,) = FRAME_HEADER.unpack(header)
+    return await reader.readexactly(length)
+
+def write_frame(writer, payload):
+    writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+
+class AsyncServer:
+    def __init__(self, bind_addr='0.0.0.0', bind_port=5535, ledger_path=None, checkpoint_interval=1024, config=CONFIG_FILE, lease=0.0,
+                 block_transactions=1024, block_bytes=1 << 20, block_delay=0.0, clients=None, ledger_class=Ledger):
+        self.bind_address_port = (bind_addr, bind_port)
+        self.clients = []
+        if clients is not None:
+            self.clients = list(clients)
+        else:
+            with open(config, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    logging.debug("Adding client {} to the list".format(line))
+                    self.clients.append(line)
+        self.ledger = open_ledger(self.clients, ledger_path, checkpoint_interval, lease, ledger_class)
+        self.snapshot = Snapshot(self.ledger)
+        self.mempool = Mempool(self.ledger, block_transactions, block_bytes, block_delay)
+        self.pending = None
+
+    def init_blockchain(self):
+        self.ledger.init_blockchain()
+        self.snapshot = Snapshot(self.ledger)
+
+    async def serve(self):
+        self.pending = asyncio.Queue()
+        writer_task = asyncio.create_task(self.apply_transactions())
+        server = await asyncio.start_server(self.handle_client, *self.bind_address_port)
+        logging.debug("Listening socket bound to {}".format(self.bind_address_port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            writer_task.cancel()
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        # requests of this connection still being answered
+        requests = set()
+        logging.info("Accepted new connection from {}".format(addr))
+        try:
+            # the first frame on every connection is the port of the client
+            client = (await read_frame(reader)).decode('utf-8').strip()
+            logging.debug("{} = {}".format(client, addr))
+            while True:
+                message = await read_frame(reader)
+                logging.debug("{} - {}".format(addr, message))
+                task = asyncio.create_task(self.answer(writer, message))
+                requests.add(task)
+                task.add_done_callback(requests.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logging.info("Connection from {} closed".format(addr))
+        except Exception:
+            logging.exception("Error while serving {}".format(addr))
+        finally:
+            for task in requests:
+                task.cancel()
+            writer.close()
+
+    async def answer(self, writer, message):
+        try:
+            write_frame(writer, await self.handle_transaction(message))
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def handle_transaction(self, message):
+        if message[:3] == protocol.SHARDS_TYPE:
+            return protocol.shards_reply(protocol.request_id_of(message))
+        if message[:3] == protocol.BALANCE_TYPE:
+            # reads never wait for the writer
+            return read_balance(self.snapshot, message)
+        # TRA and TRB batches go through the writer
+        done = asyncio.get_running_loop().create_future()
+        self.pending.put_nowait((message, done))
+        # done belongs to the writer, a client leaving must not cancel it
+        return await asyncio.shield(done)
+
+    def apply(self, message, done):
+        try:
+            reply = self.ledger.execute(message)[1]
+        except Exception as e:
+            logging.exception("Error while applying {}".format(message))
+            reply = e
+        self.mempool.add(done, reply, len(message))
+
+    async def apply_transactions(self):
+        """Single writer: the only place the ledger is modified"""
+        loop = asyncio.get_running_loop()
+        while True:
+            self.apply(*await self.pending.get())
+            # take everything already queued, then wait for more until a threshold is reached
+            while not self.mempool.full():
+                if not self.pending.empty():
+                    self.apply(*self.pending.get_nowait())
+                    continue
+                timeout = self.mempool.deadline() - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.pending.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                self.apply(*item)
+            # one block and one fsync for everything in the mempool, off the event loop
+            error = None
+            try:
+                await loop.run_in_executor(None, self.ledger.commit)
+            except Exception as e:
+                logging.exception("Error while committing the ledger")
+                error = e
+            # publish the new state before anyone hears that their transfer went through
+            self.snapshot = Snapshot(self.ledger)
+            for done, reply in self.mempool.take():
+                if done.done():
+                    continue
+                reply = error or reply
+                if isinstance(reply, Exception):
+                    done.set_exception(reply)
+                else:
+                    done.set_result(reply)
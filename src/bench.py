@@ -0,0 +1,292 @@
+"""
+End-to-end benchmark of the centralized and the replicated blockchain
+
+Starts every node on localhost without config.cfg or the REPL, drives them with
+a transfer workload and prints one JSON result per mode so runs can be compared:
+
+    dme         server.py in a subprocess and N client.py nodes in this process,
+                every transfer takes the DME and waits for the server's reply
+    direct      the same without the DME, the server alone orders the transfers
+                and every client keeps up to --window of them outstanding
+
+In both, --reads is the fraction of operations that are balance reads instead of
+transfers. Reads never take the DME and hit the client's cache while the server's
+--lease on the last answer lasts.
+    replicated  N client_replicated.py nodes in this process syncing in the
+                background, latency is the time until a transfer reaches a peer
+
+Usage: python bench.py [--mode dme|direct|replicated|all] [--nodes N] [--transfers T]
+                       [--dme ALGORITHM] [--server reactor|async] [--window W]
+                       [--reads FRACTION] [--lease SECONDS] [--block-delay SECONDS]
+                       [--shards N]
+                       [--sync-interval S] [--base-port P] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from bench_dme import percentile
+from client import Client
+from client_replicated import Client as ReplicatedClient
+from dme import DME_MODES, LamportMutex
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+def latency_summary(latencies):
+    if not latencies:
+        return {'mean': 0.0, 'p50': 0.0, 'p99': 0.0}
+    return {
+        'mean': 1000*sum(latencies)/len(latencies),
+        'p50': 1000*percentile(latencies, 50),
+        'p99': 1000*percentile(latencies, 99)
+    }
+
+def max_rss_kb(who=resource.RUSAGE_SELF):
+    # kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def start_server(port, ports, directory, kind='reactor', lease=0.0, block_delay=0.0, shards=1):
+    config = os.path.join(directory, 'config.cfg')
+    with open(config, 'w') as f:
+        f.write('\n'.join(ports) + '\n')
+    args = [sys.executable, SERVER_SCRIPT, '--in-memory', '--port', str(port), '--config', config, '--log-level', 'WARNING',
+            '--lease', str(lease), '--block-delay', str(block_delay), '--shards', str(shards)]
+    if kind == 'async':
+        args.append('--async')
+    server = subprocess.Popen(args, cwd=directory)
+    wait_for_port(port)
+    return server
+
+def run_transfers(client, peers, transfers, amount, latencies, statuses, seed, reads, read_latencies):
+    rng = random.Random(seed)
+    for _ in range(transfers):
+        start = time.perf_counter()
+        if rng.random() < reads:
+            client.request_balance().result()
+            read_latencies.append(time.perf_counter() - start)
+            continue
+        client.acquire_dme()
+        try:
+            reply = client.request_transfer(rng.choice(peers), amount).result()
+        finally:
+            client.end_dme()
+        latencies.append(time.perf_counter() - start)
+        statuses[reply.status.name] = statuses.get(reply.status.name, 0) + 1
+
+def run_direct_transfers(client, peers, transfers, amount, latencies, statuses, seed, reads, read_latencies, window):
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    outstanding = threading.Semaphore(window)
+    def done(start, future, latencies):
+        status = future.result().status.name
+        with lock:
+            latencies.append(time.perf_counter() - start)
+            if latencies is not read_latencies:
+                statuses[status] = statuses.get(status, 0) + 1
+        outstanding.release()
+    futures = []
+    for _ in range(transfers):
+        outstanding.acquire()
+        start = time.perf_counter()
+        if rng.random() < reads:
+            future, kind = client.request_balance(), read_latencies
+        else:
+            future, kind = client.request_transfer(rng.choice(peers), amount), latencies
+        future.add_done_callback(lambda future, start=start, kind=kind: done(start, future, kind))
+        futures.append(future)
+    for future in futures:
+        future.result()
+
+def run_dme(nodes, transfers, amount, base_port, algorithm=LamportMutex.name, server_kind='reactor', seed=0, direct=False, window=1,
+            reads=0.0, lease=0.0, block_delay=0.0, shards=1):
+    ports = [str(base_port+i) for i in range(nodes)]
+    server_port = base_port + nodes
+    with tempfile.TemporaryDirectory() as directory:
+        server = start_server(server_port, ports, directory, server_kind, lease, block_delay, shards)
+        try:
+            clients = [Client(port, clients=ports, dme=algorithm, server_port=server_port, direct=direct) for port in ports]
+            for c in clients:
+                t = threading.Thread(target=c.handle_connections)
+                t.daemon = True
+                t.start()
+            for c in clients:
+                c.create_connections()
+            latencies = []
+            read_latencies = []
+            statuses = {}
+            workers = []
+            for i, c in enumerate(clients):
+                peers = [p for p in ports if p != c.lclock.proc_id]
+                if direct:
+                    worker = threading.Thread(target=run_direct_transfers, args=(c, peers, transfers, amount, latencies, statuses, seed+i,
+                                                                                 reads, read_latencies, window))
+                else:
+                    worker = threading.Thread(target=run_transfers, args=(c, peers, transfers, amount, latencies, statuses, seed+i,
+                                                                          reads, read_latencies))
+                workers.append(worker)
+            start = time.perf_counter()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            elapsed = time.perf_counter() - start
+            dme_messages = sum(c.dme.messages_sent for c in clients)
+            hits = sum(c.cache.hits for c in clients)
+            misses = sum(c.cache.misses for c in clients)
+            for c in clients:
+                c.cleanup()
+        finally:
+            server.terminate()
+            server.wait()
+    completed = len(latencies)
+    # only reads that missed the cache went to the server
+    operations = completed + len(read_latencies)
+    requests = completed + misses
+    return {
+        'mode': 'direct' if direct else 'dme',
+        'dme': None if direct else algorithm,
+        'window': window if direct else 1,
+        'server': 'sharded' if shards > 1 else server_kind,
+        'shards': shards,
+        'nodes': nodes,
+        'transfers': completed,
+        'statuses': statuses,
+        'elapsed_s': elapsed,
+        'throughput_tps': completed/elapsed,
+        'latency_ms': latency_summary(latencies),
+        'reads': len(read_latencies),
+        'lease_s': lease,
+        'block_delay_s': block_delay,
+        'cache': {'hits': hits, 'misses': misses},
+        'read_latency_ms': latency_summary(read_latencies),
+        'operations_per_s': operations/elapsed,
+        'messages': {
+            'dme': dme_messages,
+            'server': 2*requests,
+            'per_transfer': (dme_messages + 2*completed)/max(1, completed),
+            'per_operation': (dme_messages + 2*requests)/max(1, operations)
+        },
+        'memory_kb': {'clients': max_rss_kb(), 'server': max_rss_kb(resource.RUSAGE_CHILDREN)}
+    }
+
+class BenchReplica(ReplicatedClient):
+    """Replicated node that timestamps the arrival of every transaction from a peer"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.arrivals = []
+
+    def append_transaction(self, data):
+        super().append_transaction(data)
+        if data['src'] != int(self.lclock.proc_id):
+            self.arrivals.append(((data['src'], data['local_time']), time.perf_counter()))
+
+def run_replicated(nodes, transfers, amount, base_port, sync_interval=0.05, sync_after=16, timeout=60.0, seed=0):
+    ports = [str(base_port+i) for i in range(nodes)]
+    clients = [BenchReplica(port, sync_interval=sync_interval, sync_after=sync_after, clients=ports) for port in ports]
+    for c in clients:
+        t = threading.Thread(target=c.handle_connections)
+        t.daemon = True
+        t.start()
+    for c in clients:
+        c.create_connections()
+    created = {}
+    def submit(c, seed):
+        rng = random.Random(seed)
+        peers = [p for p in ports if p != c.lclock.proc_id]
+        for _ in range(transfers):
+            data = c.transfer(rng.choice(peers), amount)
+            if data is not None:
+                created[(data['src'], data['local_time'])] = time.perf_counter()
+    workers = [threading.Thread(target=submit, args=(c, seed+i)) for i, c in enumerate(clients)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    submitted = time.perf_counter() - start
+    total = len(created)
+    # converged once every node holds every transaction
+    deadline = time.monotonic() + timeout
+    while any(len(c.blockchain) < total for c in clients) and time.monotonic() < deadline:
+        time.sleep(0.005)
+    converged = time.perf_counter() - start
+    complete = all(len(c.blockchain) >= total for c in clients)
+    latencies = [arrived - created[txn] for c in clients for txn, arrived in c.arrivals if txn in created]
+    stats = {key: sum(c.stats[key] for c in clients) for key in clients[0].stats}
+    for c in clients:
+        c.cleanup()
+    return {
+        'mode': 'replicated',
+        'nodes': nodes,
+        'transfers': total,
+        'sync_interval_s': sync_interval,
+        'converged': complete,
+        'submit_s': submitted,
+        'convergence_s': converged,
+        'throughput_tps': total/converged,
+        'propagation_latency_ms': latency_summary(latencies),
+        'messages': {
+            'syncs': stats['syncs_sent'],
+            'acks': stats['syncs_sent'],
+            'sync_bytes': stats['sync_bytes'],
+            'skipped_up_to_date': stats['up_to_date'],
+            'skipped_throttled': stats['throttled'],
+            'bytes_per_transfer': stats['sync_bytes']/max(1, total)
+        },
+        'memory_kb': {'nodes': max_rss_kb()}
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput, latency, message and memory cost of both blockchains")
+    parser.add_argument('--mode', choices=['dme', 'direct', 'replicated', 'all'], default='all')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--transfers', type=int, default=100, help="transfers per node")
+    parser.add_argument('--amount', type=float, default=0.01)
+    parser.add_argument('--dme', choices=sorted(DME_MODES), default=LamportMutex.name)
+    parser.add_argument('--server', choices=['reactor', 'async'], default='reactor')
+    parser.add_argument('--window', type=int, default=1, help="outstanding transfers per client in direct mode")
+    parser.add_argument('--reads', type=float, default=0.0, help="fraction of operations that are balance reads")
+    parser.add_argument('--lease', type=float, default=0.0, help="seconds the server lets clients cache a balance")
+    parser.add_argument('--block-delay', type=float, default=0.0, help="seconds the server may hold transactions to fill a block")
+    parser.add_argument('--shards', type=int, default=1, help="worker processes the server splits the accounts over")
+    parser.add_argument('--sync-interval', type=float, default=0.05)
+    parser.add_argument('--sync-after', type=int, default=16)
+    parser.add_argument('--base-port', type=int, default=9100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="also write the results to this file")
+    args = parser.parse_args()
+    results = []
+    if args.mode in ('dme', 'all'):
+        results.append(run_dme(args.nodes, args.transfers, args.amount, args.base_port, args.dme, args.server, args.seed,
+                               reads=args.reads, lease=args.lease, block_delay=args.block_delay, shards=args.shards))
+    # fresh ports for every mode so nothing is left over from the previous run
+    if args.mode in ('direct', 'all'):
+        results.append(run_dme(args.nodes, args.transfers, args.amount, args.base_port + args.nodes + 1, server_kind=args.server,
+                               seed=args.seed, direct=True, window=args.window, reads=args.reads, lease=args.lease,
+                               block_delay=args.block_delay, shards=args.shards))
+    if args.mode in ('replicated', 'all'):
+        results.append(run_replicated(args.nodes, args.transfers, args.amount, args.base_port + 2*(args.nodes + 1),
+                                      args.sync_interval, args.sync_after, seed=args.seed))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,105 @@
+"""
+Benchmark for the distributed mutual exclusion used by client.py
+
+Starts N clients in this process on consecutive localhost ports, lets every one of
+them enter the critical section a number of times and reports how long entry took,
+how many critical sections were completed per second and how many DME messages
+were sent for each. The server is not involved.
+
+Usage: python bench_dme.py [--mode MODE|all] [--nodes N] [--rounds R] [--base-port P]
+"""
+
+import argparse
+import json
+import threading
+import time
+from client import Client
+from dme import DME_MODES
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    if not samples:
+        return 0.0
+    return samples[min(len(samples)-1, int(p/100.0*len(samples)))]
+
+def start_clients(mode, nodes, base_port):
+    ports = [str(base_port+i) for i in range(nodes)]
+    clients = [Client(port, clients=ports, dme=mode) for port in ports]
+    # every listener must be served before anyone connects
+    for c in clients:
+        t = threading.Thread(target=c.handle_connections)
+        t.daemon = True
+        t.start()
+    for c in clients:
+        c.create_connections(connect_server=False)
+    return clients
+
+class Occupancy:
+    """Counts how often two clients were inside the critical section together"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inside = 0
+        self.violations = 0
+
+    def enter(self):
+        with self.lock:
+            self.inside += 1
+            if self.inside > 1:
+                self.violations += 1
+
+    def leave(self):
+        with self.lock:
+            self.inside -= 1
+
+def run_rounds(client, rounds, latencies, occupancy):
+    for _ in range(rounds):
+        start = time.perf_counter()
+        client.acquire_dme()
+        latencies.append(time.perf_counter() - start)
+        occupancy.enter()
+        occupancy.leave()
+        client.end_dme()
+
+def run(mode, nodes, rounds, base_port):
+    clients = start_clients(mode, nodes, base_port)
+    latencies = []
+    occupancy = Occupancy()
+    workers = [threading.Thread(target=run_rounds, args=(c, rounds, latencies, occupancy)) for c in clients]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    messages = sum(c.dme.messages_sent for c in clients)
+    for c in clients:
+        c.cleanup()
+    return {
+        'mode': mode,
+        'nodes': nodes,
+        'critical_sections': len(latencies),
+        'elapsed_s': elapsed,
+        'throughput_cs_per_s': len(latencies)/elapsed,
+        'mutual_exclusion_violations': occupancy.violations,
+        'messages': messages,
+        'messages_per_cs': messages/len(latencies),
+        'entry_latency_ms': {
+            'mean': 1000*sum(latencies)/len(latencies),
+            'p50': 1000*percentile(latencies, 50),
+            'p99': 1000*percentile(latencies, 99)
+        }
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Critical section latency and throughput of the DME")
+    parser.add_argument('--mode', choices=sorted(DME_MODES) + ['all'], default='all')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--base-port', type=int, default=9000)
+    args = parser.parse_args()
+    modes = sorted(DME_MODES) if args.mode == 'all' else [args.mode]
+    results = []
+    for i, mode in enumerate(modes):
+        # fresh ports for every mode so nothing is left over from the previous run
+        results.append(run(mode, args.nodes, args.rounds, args.base_port + i*args.nodes))
+    print(json.dumps(results, indent=2))
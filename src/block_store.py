@@ -0,0 +1,54 @@
+"""
+BlockStore keeps the centralized blockchain in an append-only file
+
+Blocks are written as fixed-width chain.RECORD entries. Appends only go to the
+page cache; sync() makes everything appended so far durable with one fsync, so
+a server can acknowledge a whole group of transactions per fsync. On startup
+the file is memory-mapped and scanned straight into a Chain.
+"""
+
+import logging
+import mmap
+import os
+from chain import RECORD
+
+class BlockStore:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.pending = 0
+        self.syncs = 0
+
+    def load(self, chain):
+        """Append every block in the file to chain, returns the number of blocks read"""
+        size = os.path.getsize(self.path)
+        whole = size - size % RECORD.size
+        if whole != size:
+            # a crash in the middle of a write leaves a partial record at the end
+            logging.warning("Dropping {} bytes of a torn record at the end of {}".format(size - whole, self.path))
+            self.file.truncate(whole)
+        if whole == 0:
+            return 0
+        with open(self.path, 'rb') as f:
+            with mmap.mmap(f.fileno(), whole, access=mmap.ACCESS_READ) as mapped:
+                for record in RECORD.iter_unpack(mapped):
+                    chain.append_record(record)
+        logging.info("Recovered {} blocks from {}".format(whole // RECORD.size, self.path))
+        return whole // RECORD.size
+
+    def append(self, chain, index):
+        self.file.write(chain.record(index))
+        self.pending += 1
+
+    def sync(self):
+        """Make every appended block durable, one fsync however many there are"""
+        if not self.pending:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.syncs += 1
+
+    def close(self):
+        self.sync()
+        self.file.close()
@@ -0,0 +1,132 @@
+"""
+Hash-linked blocks over the transactions of a Chain
+
+Transactions are grouped into blocks. A block header records the range of
+transactions it covers, the Merkle root of their canonical binary encoding
+(chain.RECORD) and the hash of the previous header, so changing any transaction
+or reordering blocks breaks every later link. Verification is incremental: only
+blocks sealed since the last verified height are checked.
+"""
+
+import hashlib
+import logging
+import os
+import struct
+
+# height, index of the first transaction, number of transactions, previous block hash, merkle root
+HEADER = struct.Struct('<QQI32s32s')
+GENESIS_HASH = bytes(32)
+
+def sha256(data):
+    return hashlib.sha256(data).digest()
+
+def merkle_root(leaves):
+    """Root of the Merkle tree over a list of leaf hashes, the last node of an odd level is paired with itself"""
+    if not leaves:
+        return sha256(b'')
+    level = leaves
+    while len(level) > 1:
+        if len(level) % 2:
+            level = level + [level[-1]]
+        level = [sha256(level[i] + level[i+1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+def transaction_hashes(chain, first, count):
+    """Leaf hashes of the canonical encoding of chain[first:first+count]"""
+    return [sha256(chain.record(i)) for i in range(first, first+count)]
+
+class BlockChain:
+    def __init__(self, chain, path=None):
+        self.chain = chain
+        self.headers = []
+        self.hashes = []
+        # number of transactions already in a block
+        self.sealed = 0
+        # number of blocks that passed verification
+        self.verified = 0
+        self.path = path
+        self.file = open(path, 'ab') if path else None
+        self.dirty = False
+
+    def tip_hash(self):
+        return self.hashes[-1] if self.hashes else GENESIS_HASH
+
+    def header(self, height):
+        return HEADER.unpack(self.headers[height])
+
+    def seal(self):
+        """Put every transaction that is not in a block yet into a new block, returns its height or None"""
+        count = len(self.chain) - self.sealed
+        if count <= 0:
+            return None
+        root = merkle_root(transaction_hashes(self.chain, self.sealed, count))
+        height = len(self.headers)
+        self.add(HEADER.pack(height, self.sealed, count, self.tip_hash(), root))
+        if self.file:
+            self.file.write(self.headers[-1])
+            self.dirty = True
+        logging.debug("Sealed block {} with {} transactions".format(height, count))
+        return height
+
+    def add(self, header):
+        _, first, count, _, _ = HEADER.unpack(header)
+        self.headers.append(header)
+        self.hashes.append(sha256(header))
+        self.sealed = first + count
+
+    def load(self):
+        """Read the block headers in the file, stopping at any block the chain does not fully contain"""
+        if not self.path:
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        whole = len(data) - len(data) % HEADER.size
+        for offset in range(0, whole, HEADER.size):
+            header = data[offset:offset+HEADER.size]
+            _, first, count, _, _ = HEADER.unpack(header)
+            if first + count > len(self.chain):
+                whole = offset
+                break
+            self.add(header)
+        if whole != len(data):
+            logging.warning("Dropping {} bytes of block headers at the end of {}".format(len(data) - whole, self.path))
+            self.file.truncate(whole)
+        logging.info("Loaded {} blocks from {}".format(len(self.headers), self.path))
+
+    def verify_block(self, height, prev_hash, expected_first):
+        block_height, first, count, block_prev, root = self.header(height)
+        if block_height != height or block_prev != prev_hash:
+            logging.error("Block {} is not linked to block {}".format(height, height-1))
+            return False
+        if first != expected_first:
+            logging.error("Block {} does not start where block {} ends".format(height, height-1))
+            return False
+        if merkle_root(transaction_hashes(self.chain, first, count)) != root:
+            logging.error("Merkle root of block {} does not match its transactions".format(height))
+            return False
+        return True
+
+    def verify(self):
+        """Check the blocks added since the last call, returns False at the first bad block"""
+        for height in range(self.verified, len(self.headers)):
+            prev_hash = GENESIS_HASH
+            expected_first = 0
+            if height:
+                prev_hash = self.hashes[height-1]
+                _, first, count, _, _ = self.header(height-1)
+                expected_first = first + count
+            if not self.verify_block(height, prev_hash, expected_first):
+                return False
+            self.verified = height + 1
+        return True
+
+    def sync(self):
+        if self.dirty:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
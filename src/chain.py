@@ -0,0 +1,77 @@
+"""
+Chain is an append-only, array-backed store for the blocks of a blockchain
+
+Each field of a block lives in its own typed array, so a block costs a few bytes
+per column instead of a Node object and a dict. Appends are O(1) and blocks can
+be read back by index. RECORD is the fixed-width binary encoding of one block used
+when the chain is written to disk.
+"""
+
+import struct
+from array import array
+
+BLOCK_TYPES = ('INIT', 'TRA')
+# type, src, dest, amt, local_time
+RECORD = struct.Struct('<Biidq')
+
+class Chain:
+    __slots__ = ('type', 'src', 'dest', 'amt', 'local_time')
+
+    def __init__(self):
+        self.type = array('B')
+        self.src = array('i')
+        self.dest = array('i')
+        self.amt = array('d')
+        self.local_time = array('q')
+
+    def append(self, data):
+        # data = {
+        #    'type': "TRA",
+        #    'src' : 8000,
+        #    'dest': 8001,
+        #    'amt': 5,
+        #    'local_time': 3    (replicated blockchain only)
+        # }
+        self.type.append(BLOCK_TYPES.index(data.get('type', 'TRA')))
+        self.src.append(data['src'])
+        self.dest.append(data['dest'])
+        self.amt.append(data['amt'])
+        self.local_time.append(data.get('local_time', 0))
+        return len(self.src) - 1
+
+    def append_record(self, record):
+        """Append a block given as an unpacked RECORD tuple"""
+        block_type, src, dest, amt, local_time = record
+        self.type.append(block_type)
+        self.src.append(src)
+        self.dest.append(dest)
+        self.amt.append(amt)
+        self.local_time.append(local_time)
+
+    def record(self, index):
+        return RECORD.pack(self.type[index], self.src[index], self.dest[index], self.amt[index], self.local_time[index])
+
+    def __len__(self):
+        return len(self.src)
+
+    def __getitem__(self, index):
+        return {
+            'type': BLOCK_TYPES[self.type[index]],
+            'src': self.src[index],
+            'dest': self.dest[index],
+            'amt': self.amt[index],
+            'local_time': self.local_time[index]
+        }
+
+    def __iter__(self):
+        for i in range(len(self.src)):
+            yield self[i]
+
+    @property
+    def tail(self):
+        if not self.src:
+            return None
+        return self[-1]
+
+    def __repr__(self):
+        return str(list(self))
@@ -0,0 +1,84 @@
+"""
+Checkpoints are snapshots of every account balance taken every `interval` blocks
+
+A snapshot is tied to the height of the chain it was taken at (the number of
+blocks it covers), so the balance after any block can be found by replaying only
+the blocks since the closest earlier snapshot. Snapshots can be appended to a
+file next to the chain so that a restart does not replay the whole chain either.
+"""
+
+import bisect
+import logging
+import os
+import struct
+
+# height, number of accounts
+HEADER = struct.Struct('<QI')
+# account, balance
+ENTRY = struct.Struct('<id')
+
+class Checkpoints:
+    def __init__(self, interval=1024, path=None):
+        self.interval = interval
+        self.heights = []
+        self.snapshots = []
+        self.path = path
+        self.file = open(path, 'ab') if path else None
+        self.dirty = False
+
+    def load(self, max_height):
+        """Read the snapshots in the file, dropping those taken beyond max_height from it"""
+        if not self.path:
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            height, count = HEADER.unpack_from(data, offset)
+            end = offset + HEADER.size + count*ENTRY.size
+            if end > len(data):
+                break
+            if height > max_height:
+                # the chain lost those blocks, and the snapshots taken again as it
+                # grows back must follow the ones we keep to keep heights sorted
+                logging.warning("Dropping checkpoints beyond height {} from {}".format(max_height, self.path))
+                break
+            snapshot = dict(ENTRY.iter_unpack(data[offset+HEADER.size:end]))
+            self.heights.append(height)
+            self.snapshots.append(snapshot)
+            offset = end
+        if offset != len(data):
+            logging.warning("Dropping {} bytes at the end of {}".format(len(data) - offset, self.path))
+            self.file.truncate(offset)
+        logging.info("Loaded {} checkpoints from {}".format(len(self.heights), self.path))
+
+    def maybe_take(self, height, balances):
+        if height % self.interval == 0:
+            self.take(height, balances)
+
+    def take(self, height, balances):
+        snapshot = dict(balances)
+        self.heights.append(height)
+        self.snapshots.append(snapshot)
+        if self.file:
+            self.file.write(HEADER.pack(height, len(snapshot)))
+            self.file.write(b''.join(ENTRY.pack(account, balance) for account, balance in snapshot.items()))
+            self.dirty = True
+
+    def latest(self, height):
+        """(height, balances) of the last snapshot taken at or before height, or None"""
+        i = bisect.bisect_right(self.heights, height)
+        if i == 0:
+            return None
+        return self.heights[i-1], self.snapshots[i-1]
+
+    def sync(self):
+        if self.dirty:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
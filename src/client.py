@@ -1,20 +1,63 @@
 import sys
+import argparse
 import logging
-import select
 import threading
 import socket
-from collections import deque
-import re
 import struct
+import time
+import itertools
+from concurrent.futures import Future
+import protocol
+from protocol import Status
 from simple_socket import SimpleSocket
+from reactor import Reactor
 from lamport import LamportClock
-import time
+from dme import DME_MODES, LamportMutex
 
 CONFIG_FILE = 'config.cfg'
 SERVER_PORT = 5535
 
+class BalanceCache:
+    """Balances the server has leased to us. An entry is answered from until its lease
+    runs out, and dropped as soon as one of our own transfers touching the account commits"""
+    def __init__(self):
+        # account -> (Reply, monotonic time its lease runs out)
+        self.entries = {}
+        # account -> version it is known to be at least at, after our own transfers
+        self.floor = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, account):
+        with self.lock:
+            entry = self.entries.get(account)
+            if entry is not None and time.monotonic() < entry[1]:
+                self.hits += 1
+                return entry[0]
+            self.entries.pop(account, None)
+            self.misses += 1
+            return None
+
+    def put(self, account, reply, requested_at):
+        # the lease is counted from when we asked, not from when the answer arrived
+        if reply.status != Status.OK or not reply.lease:
+            return
+        with self.lock:
+            if reply.version < self.floor.get(account, 0):
+                # read before one of our transfers committed
+                return
+            self.entries[account] = (reply, requested_at + reply.lease)
+
+    def invalidate(self, accounts, version=None):
+        with self.lock:
+            for account in accounts:
+                self.entries.pop(account, None)
+                if version is not None:
+                    self.floor[account] = max(version, self.floor.get(account, 0))
+
 class Client:
-    def __init__(self, port):
+    def __init__(self, port, clients=None, dme=LamportMutex.name, server_port=SERVER_PORT, direct=False, optimistic=False):
         # setup sockets
         self.listener = SimpleSocket(listener=True, bind_addr=('0.0.0.0'), bind_port=port)
         self.listener.bind()
@@ -24,24 +67,51 @@ class Client:
         self.outgoing_map = {}
         # lamports clock and dme
         self.lclock = LamportClock(port)
-        self.queue = deque()
-        self.socket_list = [self.listener.socket]
+        self.reactor = Reactor()
         self.clients = []
         self.server_sock = None
-        self.queue_mutex = threading.Lock()
-        with open(CONFIG_FILE, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line != port:
-                    logging.debug("Adding client {} to the list".format(line))
-                    self.clients.append(line)
+        self.server_port = server_port
+        # connections to the shards of a sharded server, requests whose accounts are
+        # all in one of them go there instead of to server_sock
+        self.shard_socks = []
+        # transfers queued with 'q', sent together with 'f'
+        self.batch = []
+        # request id -> Future of the reply, for every request the server has not answered
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        # request id -> callback run on the reply before anyone waiting on it is woken
+        self.on_reply = {}
+        # balances are read without the DME and answered from here while leased
+        self.cache = BalanceCache()
+        # direct: requests go straight to the server, which orders and validates them,
+        # instead of waiting for the DME. optimistic: transfers carry the version of our
+        # account we last saw and fail with CONFLICT if it has changed since
+        self.direct = direct
+        self.optimistic = optimistic
+        self.version = None
+        if clients is not None:
+            self.clients = [client for client in clients if client != port]
+        else:
+            with open(CONFIG_FILE, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line != port:
+                        logging.debug("Adding client {} to the list".format(line))
+                        self.clients.append(line)
+        self.dme = DME_MODES[dme](port, self.clients, self.lclock, self.send_dme_message)
     
-    def create_connections(self):
+    def create_connections(self, connect_server=True):
         # server socket
-        self.server_sock = SimpleSocket(dest_addr=('0.0.0.0'), dest_port=SERVER_PORT)
-        self.server_sock.connect()
-        logging.info("Connected to Server on {}".format(self.server_sock.socket.getpeername()))
-        self.server_sock.send(bytes(str(self.listener.bind_address_port[1]), 'UTF-8'))
+        if connect_server:
+            self.server_sock = SimpleSocket(dest_addr=('0.0.0.0'), dest_port=self.server_port)
+            self.server_sock.connect()
+            logging.info("Connected to Server on {}".format(self.server_sock.socket.getpeername()))
+            self.server_sock.send(bytes(str(self.listener.bind_address_port[1]), 'UTF-8'))
+            self.shard_socks = self.connect_shards()
+            # replies are read by the reactor thread and handed to whoever is waiting on them
+            for sock in [self.server_sock] + self.shard_socks:
+                self.reactor.add_connection(sock, self.handle_reply, self.close_server)
 
         # client sockets
         for client in self.clients:
@@ -51,118 +121,163 @@ class Client:
             logging.debug("Outgoing to {} = {}".format(client, sock.socket.getsockname()))
             sock.send(bytes(str(self.listener.bind_address_port[1]), 'UTF-8'))
 
+    def connect_shards(self):
+        """Connections to every shard of the server, none if it is not sharded"""
+        # asked before the reactor reads from the socket, so the reply is read here
+        self.server_sock.send(protocol.shards_request(0))
+        reply = protocol.parse_reply(self.server_sock.receive())
+        if reply.status != Status.OK or not reply.shards or reply.shards < 2:
+            return []
+        socks = []
+        for index in range(reply.shards):
+            sock = SimpleSocket(dest_addr=('0.0.0.0'), dest_port=reply.port + index)
+            sock.connect()
+            sock.send(bytes(str(self.listener.bind_address_port[1]), 'UTF-8'))
+            socks.append(sock)
+        logging.info("Server has {} shards on ports {} to {}".format(reply.shards, reply.port, reply.port + reply.shards - 1))
+        return socks
+
+    def connection_for(self, accounts):
+        """The shard every account is in, or the server if they are in more than one"""
+        if not self.shard_socks:
+            return self.server_sock
+        shards = set(protocol.shard_of(account, len(self.shard_socks)) for account in accounts)
+        if len(shards) != 1:
+            return self.server_sock
+        return self.shard_socks[shards.pop()]
+
     def cleanup(self):
         for client in self.clients:
             self.outgoing_map[client].socket.close()
             del(self.outgoing_map[client])
+        self.reactor.stop()
         self.listener.socket.close()
-        self.server_sock.socket.close()
+        if self.server_sock:
+            self.server_sock.socket.close()
+        for sock in self.shard_socks:
+            sock.socket.close()
 
     def handle_connections(self):
+        self.reactor.add_listener(self.listener, self.accept_connection)
         try:
-            while 1:
-                read, _, _ = select.select(self.socket_list, [], [], 0)
-                for sock in read:
-                    if sock == self.listener.socket:
-                        sockfd, addr = self.listener.socket.accept()
-                        self.socket_list.append(sockfd)
-                        logging.info("Accepted new connection from {}".format(addr))
-                    else:
-                        try:
-                            message = sock.recv(8)
-                            logging.debug("{} - {}".format(sock.getpeername(), message))
-                            if re.match("[0-9]+", message.decode('utf-8').strip()):
-                                self.incoming_map[sock] = message.decode('utf-8').strip()
-                                logging.debug("{} = {}".format(message.decode('utf-8').strip(), sock.getpeername()))
-                            elif message == b'':
-                                sock.shutdown(socket.SHUT_RDWR)
-                                sock.close()
-                                self.socket_list.remove(sock)
-                                del(self.incoming_map[sock])
-                            else:
-                                client = self.incoming_map[sock]
-                                # for i in range(len(message)):
-                                #     chunk = message[i:i+8]
-                                #     logging.debug("Chunk = {}, i={}, i+8={}, message={}".format(chunk,i,i+8, message))
-                                #     i = i+8
-                                self.handle_dme_message(message, client)
-                        except Exception:
-                            logging.exception("Error while trying to read from incoming sockets")
-                time.sleep(0.1)
+            self.reactor.run()
         except Exception:
             logging.exception("Error")
             return
 
+    def accept_connection(self, sock, addr):
+        logging.info("Accepted new connection from {}".format(addr))
+        self.reactor.add_connection(sock, self.handle_frame, self.close_connection)
+
+    def handle_frame(self, sock, message):
+        logging.debug("{} - {}".format(sock.socket.getpeername(), bytes(message)))
+        if sock not in self.incoming_map:
+            # the first frame on every connection is the port of the peer
+            client = bytes(message).decode('utf-8').strip()
+            self.incoming_map[sock] = client
+            logging.debug("{} = {}".format(client, sock.socket.getpeername()))
+        else:
+            client = self.incoming_map[sock]
+            self.handle_dme_message(message, client)
+
+    def close_connection(self, sock):
+        try:
+            sock.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # the peer may already have torn the connection down
+            pass
+        sock.close()
+        self.incoming_map.pop(sock, None)
+
+    def handle_reply(self, sock, message):
+        reply = protocol.parse_reply(message)
+        with self.pending_lock:
+            future = self.pending.pop(reply.request_id, None)
+            on_reply = self.on_reply.pop(reply.request_id, None)
+        if future is None:
+            logging.warning("Reply to unknown request {}".format(reply.request_id))
+            return
+        if on_reply is not None:
+            try:
+                on_reply(reply)
+            except Exception:
+                # the hooks only keep the cache up to date, whoever waits must still get the reply
+                logging.exception("Error while handling the reply to request {}".format(reply.request_id))
+        future.set_result(reply)
+
+    def close_server(self, sock):
+        logging.error("Connection to the server closed")
+        sock.close()
+        # the router and its shards are one server, losing any of them fails everything outstanding
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+            self.on_reply = {}
+        for future in pending.values():
+            future.set_exception(ConnectionError("Connection to the server closed"))
+
+    def send_request(self, build, on_reply=None, sock=None):
+        """Send the request build(request_id) returns on sock, the server by default, returns
+        a Future of its protocol.Reply. Any number of requests can be outstanding at once"""
+        request_id = next(self.request_ids) & 0xffffffff
+        future = Future()
+        with self.pending_lock:
+            self.pending[request_id] = future
+            if on_reply is not None:
+                self.on_reply[request_id] = on_reply
+        (sock or self.server_sock).send(build(request_id))
+        return future
+
+    def request_transfer(self, dest, amt, version=None):
+        src, dest = int(self.lclock.proc_id), int(dest)
+        def committed(reply):
+            # both accounts are now at least at the version of the block we added
+            if reply.status == Status.OK:
+                self.cache.invalidate((src, dest), reply.version)
+        return self.send_request(lambda request_id: protocol.transfer_request(request_id, src, dest, float(amt), version), committed,
+                                 self.connection_for((src, dest)))
+
+    def request_balance(self, account=None, cached=True):
+        """Balance reads do not need the DME, the server answers them from committed state.
+        While the server's lease on an earlier answer lasts it is returned without asking"""
+        account = int(self.lclock.proc_id if account is None else account)
+        reply = self.cache.get(account) if cached else None
+        if reply is not None:
+            future = Future()
+            future.set_result(reply)
+            return future
+        requested_at = time.monotonic()
+        return self.send_request(lambda request_id: protocol.balance_request(request_id, account),
+                                 lambda reply: self.cache.put(account, reply, requested_at), self.connection_for((account,)))
+
+    def request_batch(self, transfers):
+        def committed(reply):
+            # a MALFORMED reply has no statuses
+            for transfer, status, version in zip(transfers, reply.statuses or (), reply.versions or ()):
+                if status == Status.OK:
+                    self.cache.invalidate(transfer[:2], version)
+        return self.send_request(lambda request_id: protocol.batch_request(request_id, transfers), committed,
+                                 self.connection_for(account for transfer in transfers for account in transfer[:2]))
+
+    def send_dme_message(self, client, message_type, lamport_time):
+        message = struct.pack('3si', bytes(message_type, "utf-8"), lamport_time)
+        self.outgoing_map[client].send(message)
+
     def start_dme(self):
-        logging.info("Starting Lamport's DME")
-        self.queue_mutex.acquire()
-        self.lclock.update_time()
-        self.queue.append((self.lclock.proc_id, self.lclock.time, 1)) # (proc_id, no. of grants/ack; 1 is ack from self) 
-        self.queue_mutex.release()
-        logging.debug("Queue = {}".format(self.queue))
-        message = struct.pack('3si',bytes("REQ","utf-8"), self.lclock.time)
-        for client in self.clients:
-            outgoing_sock = self.outgoing_map[client]
-            logging.info("Sending REQ to {}".format(client))
-            outgoing_sock.send(bytes(message))
+        self.dme.request()
 
     def end_dme(self):
-        logging.info("Ending Lamport's DME")
-        # reverse the steps of start_dme
-        self.queue_mutex.acquire() 
-        for i in range(len(self.queue)):
-            if(self.queue[i][0]==self.lclock.proc_id):
-                self.queue.remove(self.queue[i])
-                break
-        self.lclock.update_time()
-        self.queue_mutex.release()
-        logging.debug("Queue = {}".format(self.queue))
-        message = struct.pack('3si', bytes("REL", "utf-8"), self.lclock.time)
-        for client in self.clients:
-            outgoing_sock = self.outgoing_map[client]
-            logging.info("Sending REL to {}".format(client))
-            outgoing_sock.send(bytes(message))
+        self.dme.release()
+
+    def acquire_dme(self):
+        # send our request and wait until the algorithm lets us in
+        self.dme.acquire()
 
     def handle_dme_message(self, message, client):
-        logging.debug("Message = {}".format(message))
+        logging.debug("Message = {}".format(bytes(message)))
         message_tuple = struct.unpack('3si', message)
         message_type = message_tuple[0].decode('utf-8').strip()
         remote_lclock = message_tuple[1]
-        self.queue_mutex.acquire()
-        self.lclock.update_time(remote_lclock)
-        self.queue_mutex.release()
-
-        if message_type == "REQ":
-            logging.debug("REQ from {}".format(client))
-            self.queue_mutex.acquire()
-            self.queue.append((client, remote_lclock, None))
-            self.queue = sorted(self.queue, key=lambda x: (x[1], x[0]))
-            self.lclock.update_time()
-            self.queue_mutex.release()
-            sock = self.outgoing_map[client]
-            outgoing_message = struct.pack('3si', bytes("GRA", "utf-8"), self.lclock.time)
-            logging.debug("Sending GRA to {}".format(client))
-            time.sleep(4)
-            sock.send(bytes(outgoing_message))
-        elif message_type == "GRA":
-            # search for my request
-            self.queue_mutex.acquire()
-            for i in range(len(self.queue)):
-                if(self.queue[i][0]==self.lclock.proc_id):
-                    if(self.queue[i][2]==len(self.clients)+1):
-                        continue
-                    updated_tup = (self.lclock.proc_id, self.queue[i][1], self.queue[i][2]+1)
-                    self.queue[i] = updated_tup
-            self.queue_mutex.release()
-        elif message_type == "REL":
-            logging.debug("REL from {}".format(client))
-            self.queue_mutex.acquire()
-            for i in range(len(self.queue)):
-                if(self.queue[i][0]==client):
-                    self.queue.remove(self.queue[i])
-                    break
-            self.queue_mutex.release()
-        logging.debug("Queue = {}".format(self.queue))
+        self.dme.handle_message(message_type, remote_lclock, client)
 
     def transact(self, txn_type):
         if txn_type == "t":
@@ -170,22 +285,38 @@ class Client:
             dest = input()
             print("$> amt = ", end='')
             amt = input()
-            transfer_msg = struct.pack('3siii', bytes("TRA", 'utf-8'), int(self.lclock.proc_id), int(dest.strip()), int(amt.strip()))
-            self.server_sock.send(bytes(transfer_msg))
-            reply = self.server_sock.socket.recv(1024)
-            status_msg = struct.unpack('9s', reply)
-            if(status_msg == "INCORRECT"):
-                logging.info("Transfer transaction failed")
-            elif (status_msg == "SUCCESS"):
+            reply = self.request_transfer(dest.strip(), amt.strip(), self.version if self.optimistic else None).result()
+            if reply.status == Status.OK:
                 logging.info("Transfer transaction successful")
+            elif reply.status == Status.CONFLICT:
+                logging.info("Transfer transaction failed: account changed since version {}, check the balance and retry".format(self.version))
+            else:
+                logging.info("Transfer transaction failed: {}".format(reply.status.name))
+            self.version = reply.version
         elif txn_type == "b":
-            balance_msg = struct.pack('3siii', bytes("BAL", 'utf-8'), int(self.lclock.proc_id),0,0)
-            self.server_sock.send(bytes(balance_msg))
-            reply = self.server_sock.socket.recv(1024)
-            status_msg = struct.unpack('7sf', reply)
-            bal = status_msg[1]
-            logging.info("Balance is {}".format(bal))
+            reply = self.request_balance().result()
+            self.version = reply.version
+            if reply.status == Status.OK:
+                logging.info("Balance is {}".format(reply.balance))
+            else:
+                logging.info("Balance query failed: {}".format(reply.status.name))
     
+    def queue_transfer(self, dest, amt):
+        self.batch.append((int(self.lclock.proc_id), int(dest), float(amt)))
+
+    def transact_batch(self):
+        """Send all queued transfers in one message while holding the DME.
+        Returns a list of ((src, dest, amt), success) in the order they were queued"""
+        batch, self.batch = self.batch, []
+        reply = self.request_batch(batch).result()
+        if reply.statuses is None:
+            logging.error("Batch of {} transfers rejected: {}".format(len(batch), reply.status.name))
+            results = [False] * len(batch)
+        else:
+            results = [status == Status.OK for status in reply.statuses]
+        logging.info("Batch of {} transfers, {} successful".format(len(results), sum(results)))
+        return list(zip(batch, results))
+
     def repl(self):
         print("To begin, press Enter")
         _ = input()
@@ -198,24 +329,32 @@ class Client:
             while(True):
                 print("$> ", end='')
                 inp = input()
-                if(inp == "t" or inp == "b"):
-                    # Start dme
-                    self.start_dme()
-                    # wait for GRA from everyone and check if I am at head
-                    while True:
-                        i=0
-                        self.queue_mutex.acquire()
-                        while self.queue[i][0]!=self.lclock.proc_id and i<len(self.queue):
-                            i+=1 
-                        if(self.queue[i][2]==len(self.clients)+1 and self.queue[0][0]==self.lclock.proc_id):
-                            self.queue_mutex.release()
-                            break
-                        self.queue_mutex.release()
-                        time.sleep(1)
+                if(inp == "b" or (inp == "t" and self.direct)):
+                    # the server linearizes the requests on its own, and reads are
+                    # answered from committed state without the DME
+                    self.transact(inp)
+                elif(inp == "t"):
+                    # Start dme and wait until we hold it
+                    self.acquire_dme()
                     # Access server
                     self.transact(inp)
                     # release DME
                     self.end_dme()
+                elif(inp == "q"):
+                    print("$> dest = ", end='')
+                    dest = input()
+                    print("$> amt = ", end='')
+                    amt = input()
+                    self.queue_transfer(dest.strip(), amt.strip())
+                    logging.info("{} transfers queued".format(len(self.batch)))
+                elif(inp == "f" and self.batch):
+                    # one DME round for the whole batch
+                    if not self.direct:
+                        self.acquire_dme()
+                    for (_, dest, amt), success in self.transact_batch():
+                        logging.info("Transfer of {} to {} {}".format(amt, dest, "successful" if success else "failed"))
+                    if not self.direct:
+                        self.end_dme()
                 else:
                     continue
         except KeyboardInterrupt:
@@ -224,10 +363,14 @@ class Client:
             sys.exit(1)
 
 if __name__ == "__main__":
-    if(len(sys.argv)<2):
-        print("Port is required")
-        sys.exit(1)
-    port = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Client of the centralized blockchain")
+    parser.add_argument('port', help="port of this node, as listed in {}".format(CONFIG_FILE))
+    parser.add_argument('--dme', choices=sorted(DME_MODES), default=LamportMutex.name,
+                        help="mutual exclusion algorithm, all clients must use the same one")
+    parser.add_argument('--direct', action='store_true', help="send requests straight to the server without the DME")
+    parser.add_argument('--optimistic', action='store_true', help="reject transfers if our account changed since we last saw it")
+    args = parser.parse_args()
+    port = args.port
 
     # Logging Configuration
     extra = {'port': port}
@@ -240,8 +383,15 @@ if __name__ == "__main__":
         level=logging.DEBUG,
         format='%(asctime)s - [%(levelname)s]: [%(port)s] - %(message)s', datefmt="%Y-%m-%d %H:%M:%S %z"
         )
+    def add_port(record):
+        # shared modules log through the root logger rather than the adapter below
+        if not hasattr(record, 'port'):
+            record.port = port
+        return True
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(add_port)
     logger = logging.getLogger(__name__)
     logging = logging.LoggerAdapter(logger, extra)
     logging.info("Starting Client")
-    c = Client(port)
+    c = Client(port, dme=args.dme, direct=args.direct, optimistic=args.optimistic)
     c.repl()
\ No newline at end of file
@@ -1,93 +1,75 @@
+import argparse
 import sys
 import logging
-import select
 import threading
 import socket
 from collections import deque
-import re
 import struct
+import math
 from simple_socket import SimpleSocket
+from reactor import Reactor
+from chain import Chain
+from checkpoint import Checkpoints
+from blocks import BlockChain
 from lamport import LamportClock
-import time
-import json
-import hashlib
+from event_log import EventLog
+import sync_codec
+from sync_codec import TT_DTYPE
+from verify import PARALLEL_VERIFY_THRESHOLD, snapshot, verify_records
+import numpy as np
 
 CONFIG_FILE = 'config.cfg'
+INITIAL_BALANCE = 10.0
+CHECKPOINT_INTERVAL = 1024
+# marker, size of the sync frame being acknowledged. Every sync is acknowledged,
+# in order, the marker says whether it was merged or dropped
+ACK = struct.Struct('=ci')
+MERGED = b'A'
+DROPPED = b'D'
+# background sync: seconds between rounds, new local transactions that trigger an
+# early round, and the most unacknowledged sync bytes allowed per peer
+SYNC_INTERVAL = 1.0
+SYNC_AFTER = 16
+MAX_IN_FLIGHT = 1 << 20
 
 
-class Node:
-    def __init__(self, data=None, next=None, prev=None):
-        self.data = data
-        # data = {
-        #    'type': "TRA",
-        #    'src' : 8000,
-        #    'dest': 8001,
-        #    'amt': 5    
-        # }
-        self.next = next
-        self.prev = prev
-
-    def __repr__(self):
-        return str(self.data)
-
-class LinkedList:
-    def __init__(self):
-        self.head = None
-
-    def prepend(self, data):
-        new_head = Node(data=data, next=self.head)
-        if self.head:
-            self.head.prev = new_head
-        self.head = new_head
-
-    def append(self, data):
-        if not self.head:
-            self.head = Node(data=data)
-            return
-        curr = self.head
-        while curr.next:
-            curr = curr.next
-        curr.next = Node(data=data, prev=curr)
-
 class TwoDTT:
+    """Two-dimensional time table of Wuu-Bernstein, tt[i][j] is the latest event of node j
+    that this node knows node i has seen. Rows and columns are in sorted port order, which
+    every node derives from the same config file"""
     def __init__(self, clients, my_port):
-        self.tt = []
-        self.my_row = int(my_port)-8000
-        self.row_len = len(clients) + 1
-        for _ in range(self.row_len):
-            self.tt.append([0 for _ in range(self.row_len)])
+        ports = sorted(int(client) for client in clients)
+        if int(my_port) not in ports:
+            ports = sorted(ports + [int(my_port)])
+        self.index = {port: i for i, port in enumerate(ports)}
+        self.my_row = self.index[int(my_port)]
+        self.row_len = len(ports)
+        self.tt = np.zeros((self.row_len, self.row_len), dtype=TT_DTYPE)
         logging.debug("Initialize TT = {}".format(self.tt))
-    
+
     def update_other_rows(self, twodtt):
-        for i in range(self.row_len):
-            if i == self.my_row:
-                continue
-            for j in range(self.row_len):
-                self.tt[i][j] = max(self.tt[i][j], twodtt[i][j])
+        my_row = self.tt[self.my_row].copy()
+        np.maximum(self.tt, twodtt, out=self.tt)
+        self.tt[self.my_row] = my_row
         logging.debug("Afer updating other rows = {}".format(self.tt))
-    
+
     def update_my_row(self):
-        for j in range(self.row_len):
-            max_val = 0
-            for i in range(self.row_len):
-                max_val = max(max_val,self.tt[i][j])
-            self.tt[self.my_row][j] = max_val
-        
+        self.tt[self.my_row] = self.tt.max(axis=0)
 
-    def update_my_cell(self, lclock):
-        self.tt[self.my_row][self.my_row] = lclock
+    def update_row(self, port, row):
+        i = self.index[int(port)]
+        np.maximum(self.tt[i], row, out=self.tt[i])
 
-    def unroll(self):
-        unrolled = []
-        for i in range(self.row_len):
-            for j in range(self.row_len):
-                unrolled.append(self.tt[i][j])
-        return unrolled
+    def my_row_copy(self):
+        return self.tt[self.my_row].copy()
 
+    def update_my_cell(self, lclock):
+        self.tt[self.my_row, self.my_row] = lclock
 
 
 class Client:
-    def __init__(self, port):
+    def __init__(self, port, sync_interval=SYNC_INTERVAL, sync_after=SYNC_AFTER, max_in_flight=MAX_IN_FLIGHT,
+                 compression='zlib', compress_threshold=sync_codec.COMPRESS_THRESHOLD, clients=None):
         # setup sockets
         self.listener = SimpleSocket(listener=True, bind_addr=('0.0.0.0'), bind_port=port)
         self.listener.bind()
@@ -96,20 +78,42 @@ class Client:
         self.incoming_map = {}
         self.outgoing_map = {}
         # lamports clock and blockchain
-        self.blockchain = LinkedList()
+        self.blockchain = Chain()
+        # hash-linked blocks over the local log, sealed after every sync sent or merged
+        self.blocks = BlockChain(self.blockchain)
         self.lclock = LamportClock(port)
-        self.socket_list = [self.listener.socket]
+        self.reactor = Reactor()
         self.clients = []
-        self.balance = 10.0
-        self.bhash = []
-        with open(CONFIG_FILE, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line != port:
-                    logging.debug("Adding client {} to the list".format(line))
-                    self.clients.append(line)
+        self.balance = INITIAL_BALANCE
+        # balance of every node as of the end of the local blockchain
+        self.balances = {}
+        self.checkpoints = Checkpoints(CHECKPOINT_INTERVAL)
+        # the transactions of the blockchain by origin, minus those every node has
+        self.log = EventLog()
+        if clients is not None:
+            self.clients = [client for client in clients if client != port]
+        else:
+            with open(CONFIG_FILE, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line != port:
+                        logging.debug("Adding client {} to the list".format(line))
+                        self.clients.append(line)
         self.time_table = TwoDTT(self.clients, port)
-    
+        # the log, time table and balances are shared by the repl and the reactor thread
+        self.lock = threading.RLock()
+        self.sync_interval = sync_interval
+        self.sync_after = sync_after
+        self.max_in_flight = max_in_flight
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        # local transactions since the last background round
+        self.unsynced = 0
+        # peer -> deque of (frame size, own time table row, Future or None) of the syncs it
+        # has not acknowledged
+        self.in_flight = {}
+        self.stats = {'syncs_sent': 0, 'sync_bytes': 0, 'up_to_date': 0, 'throttled': 0}
+
     def create_connections(self):
         # client sockets
         for client in self.clients:
@@ -118,122 +122,245 @@ class Client:
             sock.connect()
             logging.debug("Outgoing to {} = {}".format(client, sock.socket.getsockname()))
             sock.send(bytes(str(self.listener.bind_address_port[1]), 'UTF-8'))
+            # from here on syncs are queued on the reactor, a peer that is slow to read
+            # must not stop us from reading what it sends us
+            sock.socket.setblocking(False)
+            self.in_flight[client] = deque()
+            # acknowledgements of our syncs come back on the outgoing connection
+            self.reactor.add_connection(sock, self.handle_ack, self.close_outgoing)
 
     def cleanup(self):
-        for client in self.clients:
+        self.reactor.stop()
+        for client in list(self.outgoing_map):
             self.outgoing_map[client].socket.close()
             del(self.outgoing_map[client])
         self.listener.socket.close()
 
     def handle_connections(self):
+        self.reactor.add_listener(self.listener, self.accept_connection)
+        if self.sync_interval:
+            self.reactor.call_later(self.sync_interval, self.background_sync)
         try:
-            while 1:
-                read, _, _ = select.select(self.socket_list, [], [], 0)
-                for sock in read:
-                    if sock == self.listener.socket:
-                        sockfd, addr = self.listener.socket.accept()
-                        self.socket_list.append(sockfd)
-                        logging.info("Accepted new connection from {}".format(addr))
-                    else:
-                        try:
-                            message = sock.recv(8)
-                            logging.debug("{} - {}".format(sock.getpeername(), message))
-                            if re.match("[0-9]+", message.decode('utf-8').strip()):
-                                self.incoming_map[sock] = message.decode('utf-8').strip()
-                                logging.debug("{} = {}".format(message.decode('utf-8').strip(), sock.getpeername()))
-                            elif message == b'':
-                                sock.shutdown(socket.SHUT_RDWR)
-                                sock.close()
-                                self.socket_list.remove(sock)
-                                del(self.incoming_map[sock])
-                            else:
-                                client = self.incoming_map[sock]
-                                # message is the header
-                                length_tuple = struct.unpack('=chic',message)
-                                message_length = int(length_tuple[2])
-                                logging.debug("Message length = {}".format(message_length))
-                                blockchain = sock.recv(message_length)
-                                logging.debug("Length of partial blockchain = {}".format(len(blockchain)))
-                                logging.debug("Partial blockchain = {} - {}".format(sock.getpeername(), blockchain))
-                                struct_unpack_str = "{}i".format(int(message_length/4))
-                                logging.debug("type(message_length) = {}, {}".format(type(message_length), struct_unpack_str))
-                                unpacked_blockchain = struct.unpack(struct_unpack_str, blockchain)
-                                serialized_tt = sock.recv(9*4)
-                                logging.debug("Serialized TT = {}".format(serialized_tt))
-                                tt = struct.unpack('9i', serialized_tt)
-                                reconstructed_tt = [[0,0,0],[0,0,0],[0,0,0]] # TODO: change this if possible
-                                for i in range(3):
-                                    for j in range(3):
-                                        reconstructed_tt[i][j] = tt[3*i+j]
-                                logging.debug("Reconstructed TT = {}".format(reconstructed_tt))
-                                self.handle_message(length_tuple[1], unpacked_blockchain, client, reconstructed_tt)
-                        except Exception:
-                            logging.exception("Error while trying to read from incoming sockets")
-                time.sleep(0.1)
+            self.reactor.run()
         except Exception:
             logging.exception("Error")
             return
 
-    def handle_message(self, num_transactions, message, client, tt):
-        for i in range(num_transactions):
-            tx_type = 'TRA'
-            src = message[4*i]
-            dest = message[4*i+1]
-            amt = message[4*i+2]
-            local_time = message[4*i+3]
-            data = {
-                'type': tx_type,
-                'src': src,
-                'dest': dest,
-                'amt': amt,
-                'local_time': local_time
-            }
-            s = json.dumps(data).encode('utf-8')
-            dhash = hashlib.sha256(s).hexdigest()
-            if dhash not in self.bhash:
-                self.blockchain.append(data)
-                self.bhash.append(dhash)
-                if data['dest'] == int(self.lclock.proc_id):
-                    self.balance += data['amt']
+    def accept_connection(self, sock, addr):
+        logging.info("Accepted new connection from {}".format(addr))
+        sock.socket.setblocking(False)
+        self.reactor.add_connection(sock, self.handle_frame, self.close_connection)
+
+    def handle_frame(self, sock, message):
+        if sock not in self.incoming_map:
+            # the first frame on every connection is the port of the peer
+            client = bytes(message).decode('utf-8').strip()
+            self.incoming_map[sock] = client
+            logging.debug("{} = {}".format(client, sock.socket.getpeername()))
+            return
+        client = self.incoming_map[sock]
+        # message is the partial blockchain and the time table, see sync_codec
+        # every sync gets exactly one ACK, the sender matches them by position
+        try:
+            sync = sync_codec.decode(message)
+        except Exception:
+            logging.exception("Dropping undecodable sync from {}".format(client))
+            self.reactor.send(sock, ACK.pack(DROPPED, len(message)))
+            return
+        logging.debug("Sync of {} transactions in {} bytes from {}".format(len(sync), len(message), client))
+        if sync.tt.shape[0] != self.time_table.row_len:
+            logging.error("Dropping sync from {} with a {}x{} time table".format(client, sync.tt.shape[0], sync.tt.shape[0]))
+            self.reactor.send(sock, ACK.pack(DROPPED, len(message)))
+            return
+        logging.debug("Received TT = {}".format(sync.tt))
+        try:
+            with self.lock:
+                self.handle_message(sync, client)
+        except Exception:
+            logging.exception("Dropping sync from {} that failed to merge".format(client))
+            self.reactor.send(sock, ACK.pack(DROPPED, len(message)))
+            return
+        self.reactor.send(sock, ACK.pack(MERGED, len(message)))
+
+    def handle_ack(self, sock, message):
+        client = next(client for client, out in self.outgoing_map.items() if out is sock)
+        marker, size = ACK.unpack(message)
+        with self.lock:
+            _, row, waiter = self.in_flight[client].popleft()
+            if marker == MERGED:
+                # the peer merged our row into its own, so it has seen everything we had
+                self.time_table.update_row(client, row)
+        if marker != MERGED:
+            logging.error("{} dropped a sync of {} bytes".format(client, size))
+            if waiter:
+                waiter.set_exception(ValueError("{} dropped a sync of {} bytes".format(client, size)))
+            return
+        logging.debug("{} acknowledged a sync of {} bytes".format(client, size))
+        if waiter:
+            waiter.set_result(size)
+
+    def close_outgoing(self, sock):
+        sock.close()
+        for client, out in list(self.outgoing_map.items()):
+            if out is sock:
+                logging.warning("Connection to {} closed, no longer syncing with it".format(client))
+                del self.outgoing_map[client]
+                for _, _, waiter in self.in_flight.pop(client, ()):
+                    if waiter:
+                        waiter.set_exception(ConnectionError("Connection to {} closed".format(client)))
+
+    def close_connection(self, sock):
+        try:
+            sock.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # the peer may already have torn the connection down
+            pass
+        sock.close()
+        self.incoming_map.pop(sock, None)
+
+    def handle_message(self, sync, client):
+        me = int(self.lclock.proc_id)
+        for origin, first, count in sync.runs():
+            times = sync.local_time[first:first+count]
+            # every run is in local_time order, skip the prefix we already have
+            skip = int(np.searchsorted(times, self.log.latest.get(int(origin), -1), side='right'))
+            end = first + count
+            for dest, amt, local_time in zip(sync.dest[first+skip:end].tolist(), sync.amt[first+skip:end].tolist(), times[skip:].tolist()):
+                data = {
+                    'type': 'TRA',
+                    'src': int(origin),
+                    'dest': dest,
+                    'amt': amt,
+                    'local_time': local_time
+                }
+                self.append_transaction(data)
+                if dest == me:
+                    self.balance += amt
                 logging.debug("Appending to blockchain after receive = {}".format(data))
-        self.time_table.update_other_rows(tt)
+        self.blocks.seal()
+        self.time_table.update_other_rows(sync.tt)
         self.time_table.update_my_row()
         logging.debug("Updated TT = {}".format(self.time_table.tt))
+        dropped = self.log.truncate(self.time_table)
+        if dropped:
+            logging.debug("Dropped {} transactions every node has from the log".format(dropped))
         
 
 
 
 
-    def has_rec(self, node, recipient):
-        event_src = int(node['src'])-8000
-        recipient = int(recipient)-8000
-        logging.debug("HasRec")
-        logging.debug("Recepient = {}, Event_SRC = {}, Node Local Time = {}".format(recipient, event_src, node['local_time']))
-        if(self.time_table.tt[recipient][event_src]>=node['local_time']):
-            return True
-        return False
+    def sync(self, dest, waiter=None):
+        """Send dest every transaction it is not known to have, returns the size of the
+        frame or 0 if it is already up to date. waiter, a Future, gets the size once
+        dest acknowledges the frame"""
+        with self.lock:
+            self.blocks.seal()
+            runs = self.log.missing_runs(self.time_table, dest)
+            if not runs:
+                return 0
+            parts = sync_codec.encode(self.blockchain, runs, self.time_table.tt, self.compression, self.compress_threshold)
+            size = sum(len(part) for part in parts)
+            logging.debug("Sending {} transactions to {} in {} bytes".format(sum(len(indexes) for _, indexes in runs), dest, size))
+            self.in_flight[dest].append((size, self.time_table.my_row_copy(), waiter))
+            # the whole sync is one frame, which the reactor writes as the socket drains.
+            # Queued under the lock, so frames go out in the order of in_flight
+            sock = self.outgoing_map[dest]
+            self.reactor.call_soon_threadsafe(lambda: self.reactor.send(sock, *parts))
+            self.stats['syncs_sent'] += 1
+            self.stats['sync_bytes'] += size
+            return size
+
+    def background_sync(self):
+        """One anti-entropy round: every peer that is missing transactions gets a single
+        frame with all of them, unless too many of its sync bytes are unacknowledged"""
+        self.unsynced = 0
+        for client in list(self.outgoing_map):
+            if sum(size for size, _, _ in self.in_flight[client]) >= self.max_in_flight:
+                self.stats['throttled'] += 1
+                continue
+            try:
+                if not self.sync(client):
+                    self.stats['up_to_date'] += 1
+            except OSError:
+                logging.exception("Sync with {} failed".format(client))
+        if self.sync_interval:
+            self.reactor.call_later(self.sync_interval, self.background_sync)
+
+    def transaction_added(self):
+        self.unsynced += 1
+        if self.sync_after and self.unsynced == self.sync_after:
+            self.reactor.call_soon_threadsafe(self.background_sync)
+
+    def lagging_peers(self):
+        """Peers that are not yet known to have every transaction in the log"""
+        with self.lock:
+            return [client for client in self.clients if self.log.missing(self.time_table, client)]
 
-    def find_subset_log(self, dest):
-        dest = int(dest)
-        curr = self.blockchain.head
-        subset = []
-        while curr:
-            if not self.has_rec(curr.data, dest):
-                subset.append(curr.data)
-            curr = curr.next
-        return subset
+    def transfer(self, dest, amt):
+        """Add a transfer from this node to the local blockchain, returns it or None if
+        the amount is invalid or the balance is too low"""
+        if not math.isfinite(amt) or amt < 0:
+            logging.error("Invalid amount {}. Aborting transaction!".format(amt))
+            return None
+        with self.lock:
+            if(amt>self.balance):
+                logging.error("Amount greater than the available balance. Aborting transaction!")
+                return None
+            else:
+                self.balance -= amt
+            self.lclock.update_time()
+            self.time_table.update_my_cell(self.lclock.time)
+            logging.debug("Updated 2DTT = {}".format(self.time_table.tt))
+            data = {
+                'type': "TRA",
+                'src': int(self.lclock.proc_id),
+                'dest': int(dest),
+                'amt': amt,
+                'local_time': self.lclock.time
+            }
+            self.append_transaction(data)
+        logging.info('Inserted into the local blockchain {}'.format(data))
+        self.transaction_added()
+        return data
+
+    def verify_blocks(self):
+        """Check the blocks sealed since the last check, with a process pool once they
+        hold PARALLEL_VERIFY_THRESHOLD transactions or more"""
+        with self.lock:
+            first = self.blocks.header(self.blocks.verified)[1] if self.blocks.verified < len(self.blocks.headers) else self.blocks.sealed
+            if self.blocks.sealed - first < PARALLEL_VERIFY_THRESHOLD:
+                return self.blocks.verify()
+            # the pool hashes the whole chain again, which only pays off when most of it is new
+            headers, records = snapshot(self.blocks)
+        # blocks are only ever appended, so syncs can keep merging while the copy is hashed
+        bad = verify_records(headers, records)
+        with self.lock:
+            self.blocks.verified = len(headers) if bad is None else bad
+        return bad is None
+
+    def append_transaction(self, data):
+        index = self.blockchain.append(data)
+        self.log.add(data['src'], data['local_time'], index)
+        self.balances[data['src']] = self.balances.get(data['src'], INITIAL_BALANCE) - data['amt']
+        self.balances[data['dest']] = self.balances.get(data['dest'], INITIAL_BALANCE) + data['amt']
+        self.checkpoints.maybe_take(len(self.blockchain), self.balances)
 
     def find_client_balance(self, client):
-        bal = 10
-        curr = self.blockchain.head
-        while curr:
-            src = curr.data['src']
-            dest = curr.data['dest']
-            if(src==int(client)):
-                bal -= curr.data['amt']
-            elif(dest==int(client)):
-                bal += curr.data['amt']
-            curr = curr.next
+        return self.balances.get(int(client), INITIAL_BALANCE)
+
+    def balance_at(self, client, height):
+        """Balance of client after the first height blocks of the local blockchain"""
+        client = int(client)
+        checkpoint = self.checkpoints.latest(height)
+        start, bal = 0, INITIAL_BALANCE
+        if checkpoint:
+            start, bal = checkpoint[0], checkpoint[1].get(client, INITIAL_BALANCE)
+        chain = self.blockchain
+        for src, dest, amt in zip(chain.src[start:height], chain.dest[start:height], chain.amt[start:height]):
+            if(src==client):
+                bal -= amt
+            elif(dest==client):
+                bal += amt
         return bal
     
 
@@ -255,47 +382,17 @@ class Client:
                     print("$> dest = ", end='')
                     dest = input()
                     print("$> amt = ", end='')
-                    amt = int(input())
-                    if(amt>self.balance):
-                        logging.error("Amount greater than the available balance. Aborting transaction!")
+                    try:
+                        amt = float(input())
+                    except ValueError:
+                        logging.error("Amount must be a number")
                         continue
-                    else:
-                        self.balance -= amt
-                    self.lclock.update_time()
-                    self.time_table.update_my_cell(self.lclock.time)
-                    logging.debug("Updated 2DTT = {}".format(self.time_table.tt))
-                    data = {
-                        'type': "TRA",
-                        'src': int(self.lclock.proc_id),
-                        'dest': int(dest),
-                        'amt': int(amt),
-                        'local_time': self.lclock.time
-                    }
-                    self.blockchain.append(data)
-                    s = json.dumps(data).encode('utf-8')
-                    self.bhash.append(hashlib.sha256(s).hexdigest())
-                    logging.info('Inserted into the local blockchain {}'.format(data))
+                    self.transfer(dest, amt)
                 elif(inp == "s"):
                     print("$> dest = ", end='')
                     dest = input()
-                    log_subset = self.find_subset_log(dest)
-                    # header structure
-                    # total 8 bytes - 4 bytes number of transactions + 4 bytes total size of the log
-                    header = struct.pack('=chic', bytes('H','utf-8'),len(log_subset), 16*len(log_subset),bytes('H', 'utf-8'))
-                    self.outgoing_map[dest].send(bytes(header))
-                    unrolled_list = []
-                    for item in log_subset:
-                        unrolled_list.append(item['src'])
-                        unrolled_list.append(item['dest'])
-                        unrolled_list.append(item['amt'])
-                        unrolled_list.append(item['local_time'])
-                    serialized_list = struct.pack('{}i'.format(len(unrolled_list)), *unrolled_list)
-                    logging.debug("Sending struct with data = {}".format(serialized_list))
-                    logging.debug("Packed struct with format = {}".format('{}i'.format(len(unrolled_list))))
-                    self.outgoing_map[dest].send(bytes(serialized_list))
-                    unrolled_tt = self.time_table.unroll()
-                    serialized_tt = struct.pack('{}i'.format(len(unrolled_tt)), *unrolled_tt)
-                    self.outgoing_map[dest].send(bytes(serialized_tt))
+                    if not self.sync(dest):
+                        logging.info("{} already has every transaction".format(dest))
                 elif(inp=="b"):
                     node = input("$> node = ")
                     if node == self.lclock.proc_id:
@@ -303,6 +400,13 @@ class Client:
                     else:
                         bal = self.find_client_balance(node)
                         logging.info("Node {}'s balance is {}".format(node, bal))
+                elif(inp=="v"):
+                    # only the blocks sealed since the last check are hashed again
+                    valid = self.verify_blocks()
+                    if valid:
+                        logging.info("Blockchain verified up to block {}".format(self.blocks.verified))
+                    else:
+                        logging.error("Blockchain verification failed at block {}".format(self.blocks.verified))
                 else:
                     continue
         except KeyboardInterrupt:
@@ -311,10 +415,15 @@ class Client:
             sys.exit(1)
 
 if __name__ == "__main__":
-    if(len(sys.argv)<2):
-        print("Port is required")
-        sys.exit(1)
-    port = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Replicated blockchain node")
+    parser.add_argument('port', help="port of this node, as listed in {}".format(CONFIG_FILE))
+    parser.add_argument('--sync-interval', type=float, default=SYNC_INTERVAL, help="seconds between background syncs, 0 turns them off")
+    parser.add_argument('--sync-after', type=int, default=SYNC_AFTER, help="new local transactions that trigger a background sync early, 0 turns this off")
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT, help="unacknowledged sync bytes after which a peer is skipped")
+    parser.add_argument('--compression', choices=sorted(sync_codec.CODECS), default='zlib', help="compression of large syncs")
+    parser.add_argument('--compress-threshold', type=int, default=sync_codec.COMPRESS_THRESHOLD, help="smallest sync body in bytes that is compressed")
+    args = parser.parse_args()
+    port = args.port
 
     # Logging Configuration
     extra = {'port': port}
@@ -327,8 +436,15 @@ if __name__ == "__main__":
         level=logging.DEBUG,
         format='%(asctime)s - [%(levelname)s]: [%(port)s] - %(message)s', datefmt="%Y-%m-%d %H:%M:%S %z"
         )
+    def add_port(record):
+        # shared modules log through the root logger rather than the adapter below
+        if not hasattr(record, 'port'):
+            record.port = port
+        return True
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(add_port)
     logger = logging.getLogger(__name__)
     logging = logging.LoggerAdapter(logger, extra)
     logging.info("Starting Client")
-    c = Client(port)
+    c = Client(port, args.sync_interval, args.sync_after, args.max_in_flight, args.compression, args.compress_threshold)
     c.repl()
\ No newline at end of file
@@ -0,0 +1,339 @@
+"""
+Distributed mutual exclusion algorithms for client.py and the data structures they use
+
+The algorithm is selected per run from DME_MODES.
+"""
+
+import heapq
+import logging
+import math
+import threading
+
+logger = logging.getLogger('client')
+
+class RequestQueue:
+    """Requests for the critical section ordered by (lamport_time, proc_id)
+
+    Backed by a binary heap with an index from proc_id to its entry, so adding or
+    removing a request is O(log n) and finding the head is amortized O(1). Every
+    process has at most one outstanding request.
+    """
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+
+    def push(self, proc_id, lamport_time):
+        if proc_id in self.entries:
+            self.remove(proc_id)
+        # [time, proc_id, live]; ties on time are broken by proc_id
+        entry = [lamport_time, proc_id, True]
+        self.entries[proc_id] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove(self, proc_id):
+        entry = self.entries.pop(proc_id, None)
+        if entry is None:
+            return
+        # lazy deletion, the entry is dropped once it reaches the top of the heap
+        entry[2] = False
+        if len(self.heap) > 2*len(self.entries) + 16:
+            self.heap = [e for e in self.heap if e[2]]
+            heapq.heapify(self.heap)
+
+    def head(self):
+        """proc_id of the earliest request or None"""
+        heap = self.heap
+        while heap and not heap[0][2]:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return heap[0][1]
+
+    def time_of(self, proc_id):
+        return self.entries[proc_id][0]
+
+    def __contains__(self, proc_id):
+        return proc_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return str(sorted((e[0], e[1]) for e in self.entries.values()))
+
+def priority(lamport_time, proc_id):
+    return (lamport_time, int(proc_id))
+
+class MutualExclusion:
+    """Base class of the DME algorithms a client can run
+
+    proc_id and peers are the ports of this process and of the other processes,
+    transport(client, message_type, lamport_time) sends one message to a peer.
+    Handlers run with self.mutex held and only queue outgoing messages; flush()
+    sends them afterwards, in order, so no socket write happens under the lock.
+    Messages addressed to ourselves are delivered locally and not counted.
+    """
+    name = None
+
+    def __init__(self, proc_id, peers, lclock, transport):
+        self.proc_id = proc_id
+        self.peers = list(peers)
+        self.lclock = lclock
+        self.transport = transport
+        self.mutex = threading.Lock()
+        self.cond = threading.Condition(self.mutex)
+        self.send_lock = threading.Lock()
+        self.outbox = []
+        self.messages_sent = 0
+        # client.py logs with the port of the node, see lamport.py
+        self.logger = logging.LoggerAdapter(logger, {'port': proc_id})
+
+    def post(self, client, message_type, lamport_time=None):
+        if lamport_time is None:
+            lamport_time = self.lclock.update_time()
+        self.outbox.append((client, message_type, lamport_time))
+
+    def flush(self):
+        with self.send_lock:
+            while True:
+                with self.mutex:
+                    if not self.outbox:
+                        return
+                    outbox, self.outbox = self.outbox, []
+                for client, message_type, lamport_time in outbox:
+                    if client == self.proc_id:
+                        with self.mutex:
+                            self.on_message(message_type, lamport_time, client)
+                            self.cond.notify_all()
+                    else:
+                        self.logger.debug("Sending {} to {}".format(message_type, client))
+                        self.messages_sent += 1
+                        self.transport(client, message_type, lamport_time)
+
+    def request(self):
+        self.logger.info("Starting {} DME".format(self.name))
+        with self.mutex:
+            self.on_request()
+        self.flush()
+
+    def wait(self):
+        with self.mutex:
+            self.cond.wait_for(self.can_enter)
+            self.on_enter()
+
+    def acquire(self):
+        self.request()
+        self.wait()
+
+    def release(self):
+        self.logger.info("Ending {} DME".format(self.name))
+        with self.mutex:
+            self.on_release()
+        self.flush()
+
+    def handle_message(self, message_type, remote_lclock, client):
+        with self.mutex:
+            self.lclock.update_time(remote_lclock)
+            self.logger.debug("{} from {}".format(message_type, client))
+            self.on_message(message_type, remote_lclock, client)
+            self.cond.notify_all()
+        self.flush()
+
+    def on_enter(self):
+        pass
+
+class LamportMutex(MutualExclusion):
+    """Lamport's algorithm: REQ, GRA and REL to and from everyone, 3(N-1) messages"""
+    name = 'lamport'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.queue = RequestQueue()
+        self.grants = 0
+
+    def on_request(self):
+        request_time = self.lclock.update_time()
+        self.queue.push(self.proc_id, request_time)
+        self.grants = 1 # 1 is the ack from self
+        for client in self.peers:
+            self.post(client, "REQ", request_time)
+
+    def can_enter(self):
+        # all grants are in and our request is at the head
+        return self.grants == len(self.peers)+1 and self.queue.head() == self.proc_id
+
+    def on_release(self):
+        self.queue.remove(self.proc_id)
+        release_time = self.lclock.update_time()
+        for client in self.peers:
+            self.post(client, "REL", release_time)
+
+    def on_message(self, message_type, remote_lclock, client):
+        if message_type == "REQ":
+            self.queue.push(client, remote_lclock)
+            self.post(client, "GRA")
+        elif message_type == "GRA":
+            if self.proc_id in self.queue and self.grants < len(self.peers)+1:
+                self.grants += 1
+        elif message_type == "REL":
+            self.queue.remove(client)
+
+class RicartAgrawalaMutex(MutualExclusion):
+    """Ricart-Agrawala: replies to later requests are deferred until we leave, 2(N-1) messages"""
+    name = 'ricart-agrawala'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.requesting = False
+        self.request_time = None
+        self.replies = set()
+        self.deferred = []
+
+    def on_request(self):
+        self.request_time = self.lclock.update_time()
+        self.requesting = True
+        self.replies = set()
+        for client in self.peers:
+            self.post(client, "REQ", self.request_time)
+
+    def can_enter(self):
+        return len(self.replies) == len(self.peers)
+
+    def on_release(self):
+        self.requesting = False
+        for client in self.deferred:
+            self.post(client, "GRA")
+        self.deferred = []
+
+    def on_message(self, message_type, remote_lclock, client):
+        if message_type == "REQ":
+            if self.requesting and priority(self.request_time, self.proc_id) < priority(remote_lclock, client):
+                self.deferred.append(client)
+            else:
+                self.post(client, "GRA")
+        elif message_type == "GRA":
+            if self.requesting:
+                self.replies.add(client)
+
+def grid_quorum(members, proc_id):
+    """Row and column of proc_id when members are laid out in a sqrt(N) wide grid.
+    Any two such quorums intersect."""
+    members = sorted(members, key=int)
+    width = int(math.ceil(math.sqrt(len(members))))
+    index = members.index(proc_id)
+    row, col = divmod(index, width)
+    quorum = set(members[row*width:(row+1)*width])
+    quorum.update(members[col::width])
+    return quorum
+
+class MaekawaMutex(MutualExclusion):
+    """Maekawa's algorithm over grid quorums, O(sqrt(N)) messages per critical section
+
+    Every process is also the arbiter for the quorums it belongs to. Deadlocks
+    are avoided with INQ (inquire), FAL (failed) and YLD (yield) messages.
+    """
+    name = 'maekawa'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.quorum = grid_quorum(self.peers + [self.proc_id], self.proc_id)
+        # requester state
+        self.requesting = False
+        self.in_cs = False
+        self.request_time = None
+        self.granted_by = set()
+        self.failed = False
+        self.inquiries = set()
+        # arbiter state
+        self.locked_for = None
+        self.waiting = RequestQueue()
+        self.inquired = False
+
+    def on_request(self):
+        self.request_time = self.lclock.update_time()
+        self.requesting = True
+        self.granted_by = set()
+        self.failed = False
+        self.inquiries = set()
+        for client in self.quorum:
+            self.post(client, "REQ", self.request_time)
+
+    def can_enter(self):
+        return self.requesting and self.granted_by == self.quorum
+
+    def on_enter(self):
+        self.in_cs = True
+
+    def on_release(self):
+        self.requesting = False
+        self.in_cs = False
+        self.granted_by = set()
+        self.inquiries = set()
+        for client in self.quorum:
+            self.post(client, "REL")
+
+    def yield_to(self, client):
+        self.granted_by.discard(client)
+        self.failed = True
+        self.post(client, "YLD")
+
+    def grant_next(self):
+        client = self.waiting.head()
+        self.inquired = False
+        if client is None:
+            self.locked_for = None
+            return
+        self.locked_for = (self.waiting.time_of(client), client)
+        self.waiting.remove(client)
+        self.post(client, "GRA")
+
+    def on_message(self, message_type, remote_lclock, client):
+        # arbiter side
+        if message_type == "REQ":
+            if self.locked_for is None:
+                self.locked_for = (remote_lclock, client)
+                self.post(client, "GRA")
+                return
+            previous_head = self.waiting.head()
+            self.waiting.push(client, remote_lclock)
+            if self.waiting.head() == client and priority(remote_lclock, client) < priority(*self.locked_for):
+                # the new request beats everything here, ask the holder to give the grant back
+                if previous_head is not None:
+                    self.post(previous_head, "FAL")
+                if not self.inquired:
+                    self.inquired = True
+                    self.post(self.locked_for[1], "INQ")
+            else:
+                self.post(client, "FAL")
+        elif message_type == "YLD":
+            if self.locked_for is not None and self.locked_for[1] == client:
+                self.waiting.push(client, self.locked_for[0])
+                self.grant_next()
+        elif message_type == "REL":
+            if self.locked_for is not None and self.locked_for[1] == client:
+                self.grant_next()
+        # requester side
+        elif message_type == "GRA":
+            if self.requesting:
+                self.granted_by.add(client)
+        elif message_type == "FAL":
+            if self.requesting and not self.in_cs:
+                self.failed = True
+                for inquirer in self.inquiries:
+                    if inquirer in self.granted_by:
+                        self.yield_to(inquirer)
+                self.inquiries = set()
+        elif message_type == "INQ":
+            if not self.requesting or self.in_cs or client not in self.granted_by:
+                # stale, or we will release soon anyway
+                return
+            if self.failed:
+                self.yield_to(client)
+            else:
+                self.inquiries.add(client)
+
+DME_MODES = {
+    LamportMutex.name: LamportMutex,
+    RicartAgrawalaMutex.name: RicartAgrawalaMutex,
+    MaekawaMutex.name: MaekawaMutex
+}
@@ -0,0 +1,69 @@
+"""
+EventLog indexes the transactions of a replicated blockchain by the node they originated at
+
+Every node creates its transactions with increasing lamport times and Wuu-Bernstein
+only ever forwards the events a peer does not have yet, so the events of one origin
+held by any node are always a prefix of everything that origin created. Keeping
+them in a per-origin array ordered by local_time turns "which events has this peer
+not seen" into one bisect per origin, and lets the events every peer is known to
+have be dropped from the front of the arrays (the Wuu-Bernstein truncation rule).
+Dropped events stay in the blockchain; they are only never sent again.
+"""
+
+import bisect
+from array import array
+
+class EventLog:
+    def __init__(self):
+        # origin -> local times of its events still in the log, ascending
+        self.times = {}
+        # origin -> index in the blockchain of each of those events
+        self.indexes = {}
+        # origin -> latest local time received from it, kept after truncation
+        self.latest = {}
+
+    def has(self, origin, local_time):
+        return local_time <= self.latest.get(origin, -1)
+
+    def add(self, origin, local_time, index):
+        """Record that the blockchain holds the event of origin at local_time at index,
+        returns False if it was already known"""
+        if self.has(origin, local_time):
+            return False
+        if origin not in self.times:
+            self.times[origin] = array('q')
+            self.indexes[origin] = array('q')
+        self.times[origin].append(local_time)
+        self.indexes[origin].append(index)
+        self.latest[origin] = local_time
+        return True
+
+    def missing_runs(self, time_table, recipient):
+        """(origin, blockchain indexes) of the events recipient is not known to have, for
+        every origin it is missing some from, indexes in local_time order"""
+        known = time_table.tt[time_table.index[int(recipient)]]
+        runs = []
+        for origin, times in self.times.items():
+            first = bisect.bisect_right(times, known[time_table.index[origin]])
+            if first < len(times):
+                runs.append((origin, self.indexes[origin][first:]))
+        return runs
+
+    def missing(self, time_table, recipient):
+        """Blockchain indexes of the events recipient is not known to have"""
+        return [index for _, indexes in self.missing_runs(time_table, recipient) for index in indexes]
+
+    def truncate(self, time_table):
+        """Drop the events every node is known to have, returns how many were dropped"""
+        known = time_table.tt.min(axis=0)
+        dropped = 0
+        for origin, times in self.times.items():
+            first = bisect.bisect_right(times, known[time_table.index[origin]])
+            if first:
+                del times[:first]
+                del self.indexes[origin][:first]
+                dropped += first
+        return dropped
+
+    def __len__(self):
+        return sum(len(times) for times in self.times.values())
@@ -0,0 +1,213 @@
+"""
+Ledger holds the centralized blockchain together with the balance index built from it
+
+It is shared by the threaded and the asyncio servers so that both validate and
+apply transactions the same way.
+"""
+
+import logging
+import math
+import protocol
+from protocol import Status
+from chain import Chain
+from checkpoint import Checkpoints
+from block_store import BlockStore
+from blocks import BlockChain
+from verify import verify_file, PARALLEL_VERIFY_THRESHOLD
+
+class Ledger:
+    def __init__(self, clients, store=None, checkpoints=None, blocks_path=None, lease=0.0):
+        self.clients = clients
+        self.blockchain = Chain()
+        # hash-linked blocks, a new one is sealed at every commit
+        self.blocks = BlockChain(self.blockchain, blocks_path)
+        self.balances = self.initial_balances()
+        # optional block_store.BlockStore the chain is persisted to
+        self.store = store
+        self.checkpoints = checkpoints if checkpoints is not None else Checkpoints()
+        # height of the chain after the last block that touched each account, accounts
+        # not in here were last touched at or before base_version
+        self.versions = {}
+        self.base_version = 0
+        # seconds clients may answer balance reads from their cache, see protocol
+        self.lease = lease
+
+    def initial_balances(self):
+        client_balance = {0:30.0}
+        for client in self.clients:
+            client_balance[int(client)] = 0.0
+        return client_balance
+
+    def append_block(self, data):
+        # every block goes through here so that the balance index stays in step with the chain
+        index = self.blockchain.append(data)
+        if self.store:
+            self.store.append(self.blockchain, index)
+        self.balances[data['src']] -= data['amt']
+        self.balances[data['dest']] += data['amt']
+        self.versions[data['src']] = self.versions[data['dest']] = index + 1
+        self.checkpoints.maybe_take(len(self.blockchain), self.balances)
+
+    def version(self, account):
+        return self.versions.get(account, self.base_version)
+
+    def rebuild_balances(self):
+        # iterate through the blockchain to see the balance of each client at the last block
+        client_balance = self.initial_balances()
+        chain = self.blockchain
+        for src, dest, amt in zip(chain.src, chain.dest, chain.amt):
+            client_balance[src] -= amt
+            client_balance[dest] += amt
+        return client_balance
+
+    def balances_at(self, height):
+        """Balances after the first height blocks, replaying only from the closest checkpoint"""
+        checkpoint = self.checkpoints.latest(height)
+        if checkpoint:
+            start, client_balance = checkpoint[0], dict(checkpoint[1])
+        else:
+            start, client_balance = 0, self.initial_balances()
+        chain = self.blockchain
+        for src, dest, amt in zip(chain.src[start:height], chain.dest[start:height], chain.amt[start:height]):
+            client_balance[src] -= amt
+            client_balance[dest] += amt
+        return client_balance
+
+    def balance_at(self, account, height):
+        return self.balances_at(height)[account]
+
+    def verify_balances(self):
+        rebuilt = self.rebuild_balances()
+        if rebuilt != self.balances:
+            logging.error("Balance index {} does not match the blockchain {}".format(self.balances, rebuilt))
+            self.balances = rebuilt
+            return False
+        return True
+
+    def init_blockchain(self):
+        if self.store and self.store.load(self.blockchain):
+            # restart, the chain on disk already has the INIT blocks
+            self.checkpoints.load(len(self.blockchain))
+            self.balances = self.balances_at(len(self.blockchain))
+            # versions only ever grow, so restarting every account at the height is safe
+            self.base_version = len(self.blockchain)
+            self.blocks.load()
+            self.verify_blocks()
+            logging.info("Balance vector after recovery = {}".format(self.balances))
+            return
+        for client in self.clients:
+            data = {
+                'type': "INIT",
+                'src': 0,
+                'dest': int(client),
+                'amt': 10.0
+            }
+            self.append_block(data)
+        self.verify_balances()
+        self.commit()
+
+    def verify_blocks(self):
+        if self.store and len(self.blockchain) >= PARALLEL_VERIFY_THRESHOLD:
+            # big chains are hashed by a process pool straight from the files
+            bad = verify_file(self.store.path, self.blocks.path)
+            self.blocks.verified = len(self.blocks.headers) if bad is None else bad
+            valid = bad is None
+        else:
+            valid = self.blocks.verify()
+        if not valid:
+            logging.error("Blockchain on disk failed verification at block {}".format(self.blocks.verified))
+        return valid
+
+    def unsealed(self):
+        """Number of transactions applied since the last block was sealed"""
+        return len(self.blockchain) - self.blocks.sealed
+
+    def commit(self):
+        """Seal the transactions appended so far into a block and make everything durable"""
+        self.blocks.seal()
+        if self.store:
+            self.store.sync()
+        self.checkpoints.sync()
+        self.blocks.sync()
+
+    def check_transfer(self, src, dest, amt):
+        balances = self.balances
+        if src not in balances or dest not in balances:
+            return Status.UNKNOWN_ACCOUNT
+        if not math.isfinite(amt) or amt < 0:
+            return Status.INVALID_AMOUNT
+        if amt > balances[src]:
+            return Status.INSUFFICIENT_FUNDS
+        return Status.OK
+
+    def transfer(self, src, dest, amt, version=None):
+        """Validate and apply one transfer, returns its Status. With a version the transfer
+        only goes through if src has not changed since that version"""
+        if version is not None and src in self.balances and version != self.version(src):
+            return Status.CONFLICT
+        status = self.check_transfer(src, dest, amt)
+        if status == Status.OK:
+            self.append_block({'type': 'TRA', 'src': src, 'dest': dest, 'amt': amt})
+        return status
+
+    def execute(self, message):
+        """Validate and apply a request frame (see protocol), returns the account that
+        sent it and the reply"""
+        try:
+            kind, request_id, body = protocol.parse_request(message)
+        except ValueError:
+            logging.exception("Dropping malformed request")
+            return None, protocol.status_reply(bytes(message[:3]), protocol.request_id_of(message), Status.MALFORMED)
+        logging.debug("Request {} {} {}".format(kind, request_id, body))
+        if kind in (protocol.TRANSFER_TYPE, protocol.TRANSFER_IF_TYPE):
+            src, dest, amt, version = body
+            status = self.transfer(src, dest, amt, version)
+            logging.debug("Sending {} to {}".format(status.name, src))
+            return src, protocol.transfer_reply(kind, request_id, status, self.version(src))
+        elif kind == protocol.BALANCE_TYPE:
+            logging.debug("Sending balance to {}".format(body))
+            return body, balance_reply(request_id, self, body)
+        return self.execute_batch(request_id, body)
+
+    def execute_batch(self, request_id, transfers):
+        """Validate and apply a TRB batch of transfers in one pass, each one sees the
+        effect of the ones before it. The reply carries one status and version per transfer"""
+        statuses = []
+        versions = []
+        for src, dest, amt in transfers:
+            statuses.append(self.transfer(src, dest, amt))
+            versions.append(self.version(src))
+        src = transfers[0][0] if transfers else None
+        logging.debug("Batch of {} transfers from {}, statuses {}".format(len(transfers), src, [int(status) for status in statuses]))
+        return src, protocol.batch_reply(request_id, statuses, versions)
+
+def open_ledger(clients, path=None, checkpoint_interval=1024, lease=0.0, ledger_class=Ledger):
+    """Ledger persisted to path and path.ckpt, or kept in memory when path is None"""
+    if not path:
+        return ledger_class(clients, checkpoints=Checkpoints(checkpoint_interval), lease=lease)
+    return ledger_class(clients, BlockStore(path), Checkpoints(checkpoint_interval, path + '.ckpt'), path + '.blocks', lease)
+
+class Snapshot:
+    """Copy of the balances and versions of a ledger, for answering reads while it changes"""
+    def __init__(self, ledger):
+        self.balances = dict(ledger.balances)
+        self.versions = dict(ledger.versions)
+        self.base_version = ledger.base_version
+        self.lease = ledger.lease
+
+    def version(self, account):
+        return self.versions.get(account, self.base_version)
+
+def read_balance(state, message):
+    """Reply to a BAL frame from a Ledger or a Snapshot"""
+    try:
+        _, request_id, account = protocol.parse_request(message)
+    except ValueError:
+        return protocol.status_reply(protocol.BALANCE_TYPE, protocol.request_id_of(message), Status.MALFORMED)
+    return balance_reply(request_id, state, account)
+
+def balance_reply(request_id, state, account):
+    """Reply to a BAL from a Ledger or a Snapshot"""
+    if account not in state.balances:
+        return protocol.balance_reply(request_id, 0.0, 0, status=Status.UNKNOWN_ACCOUNT)
+    return protocol.balance_reply(request_id, state.balances[account], state.version(account), state.lease)
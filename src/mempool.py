@@ -0,0 +1,52 @@
+"""
+Mempool holds the replies to transactions the server has applied but not yet sealed
+
+Transfers are validated against the pending state (the ledger balances include
+every transaction applied so far) and appended to the chain straight away, but
+their replies wait here until the block they end up in is sealed and on disk.
+A block is sealed once it holds max_transactions transactions or max_bytes of
+requests, or once the oldest of them has waited max_delay seconds, so the cost
+of sealing, hashing and fsyncing a block is shared by everything in it. With a
+max_delay of 0 the servers seal whenever they run out of requests to read.
+"""
+
+import time
+
+class Mempool:
+    def __init__(self, ledger, max_transactions=1024, max_bytes=1 << 20, max_delay=0.0):
+        self.ledger = ledger
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        # (whoever is waiting, reply) in the order the requests were applied
+        self.entries = []
+        self.size = 0
+        self.since = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, waiter, reply, size):
+        if not self.entries:
+            self.since = time.monotonic()
+        self.entries.append((waiter, reply))
+        self.size += size
+
+    def full(self):
+        return self.ledger.unsealed() >= self.max_transactions or self.size >= self.max_bytes
+
+    def deadline(self):
+        """monotonic time by which the pending transactions must be sealed, None if there are none"""
+        if not self.entries:
+            return None
+        return self.since + self.max_delay
+
+    def due(self):
+        return bool(self.entries) and (self.full() or time.monotonic() >= self.deadline())
+
+    def take(self):
+        """Replies waiting on the block just sealed, in order"""
+        entries, self.entries = self.entries, []
+        self.size = 0
+        self.since = None
+        return entries
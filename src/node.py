@@ -0,0 +1,165 @@
+"""
+Library interface to the blockchain nodes, without config.cfg or the REPL
+
+CentralizedNode wraps a client.py Client and ReplicatedNode a client_replicated.py
+Client. Both take their peers as a list of ports, are started and stopped
+explicitly and answer transfer(), balance() and sync() with a
+concurrent.futures.Future, so they can be embedded in other programs, run many to
+a process for simulations and driven by tests and load generators.
+
+    nodes = [ReplicatedNode(port, ports) for port in ports]
+    start_nodes(nodes)
+    nodes[0].transfer(ports[1], 2.5).result()
+    nodes[0].sync().result()
+    stop_nodes(nodes)
+"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from client import Client, SERVER_PORT
+from client_replicated import Client as ReplicatedClient
+from dme import LamportMutex
+
+def completed(result=None, exception=None):
+    future = Future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+def gather(futures):
+    """Future of the list of results of futures, fails with the first exception"""
+    result = Future()
+    futures = list(futures)
+    if not futures:
+        result.set_result([])
+        return result
+    remaining = [len(futures)]
+    lock = threading.Lock()
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        for future in futures:
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+                return
+        result.set_result([future.result() for future in futures])
+    for future in futures:
+        future.add_done_callback(done)
+    return result
+
+class Node:
+    """Common lifecycle, self.client is created by the subclasses"""
+    def __init__(self):
+        self.thread = None
+
+    def listen(self):
+        """Start serving connections from peers"""
+        self.thread = threading.Thread(target=self.client.handle_connections)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def connect(self):
+        """Connect to every peer, which must all be listening"""
+        self.client.create_connections()
+
+    def start(self):
+        self.listen()
+        self.connect()
+
+    def stop(self):
+        self.client.cleanup()
+        if self.thread:
+            self.thread.join()
+
+    @property
+    def port(self):
+        return self.client.lclock.proc_id
+
+def start_nodes(nodes):
+    # every node must be accepting before anyone connects
+    for node in nodes:
+        node.listen()
+    for node in nodes:
+        node.connect()
+
+def stop_nodes(nodes):
+    for node in nodes:
+        node.stop()
+
+class CentralizedNode(Node):
+    """Client of server.py, every transfer runs inside the distributed mutual exclusion
+    unless direct is set, in which case the server alone orders them"""
+    def __init__(self, port, peers, server_port=SERVER_PORT, dme=LamportMutex.name, direct=False):
+        super().__init__()
+        self.client = Client(str(port), clients=[str(peer) for peer in peers], dme=dme, server_port=server_port, direct=direct)
+        # one critical section at a time, in the order they were asked for
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def stop(self):
+        self.executor.shutdown()
+        super().stop()
+
+    def critical_section(self, request):
+        self.client.acquire_dme()
+        try:
+            return request().result()
+        finally:
+            self.client.end_dme()
+
+    def transfer(self, dest, amt, version=None):
+        """Future of the protocol.Reply of the server. With a version the server rejects the
+        transfer with CONFLICT if our account has changed since"""
+        if self.client.direct:
+            return self.client.request_transfer(dest, amt, version)
+        return self.executor.submit(self.critical_section, lambda: self.client.request_transfer(dest, amt, version))
+
+    def balance(self, account=None, cached=True):
+        """Future of the protocol.Reply of the server, with the balance and its version.
+        Reads never take the DME, and while a lease lasts are answered from the cache"""
+        return self.client.request_balance(account, cached)
+
+    def sync(self):
+        """The server is the only copy, so this only waits for the requests made so far"""
+        with self.client.pending_lock:
+            outstanding = gather(list(self.client.pending.values()))
+        if self.client.direct:
+            return outstanding
+        # transfers still waiting for the DME have not been sent yet
+        return self.executor.submit(outstanding.result)
+
+class ReplicatedNode(Node):
+    """Replica of the Wuu-Bernstein blockchain, options are passed to its Client"""
+    def __init__(self, port, peers, **options):
+        super().__init__()
+        self.client = ReplicatedClient(str(port), clients=[str(peer) for peer in peers], **options)
+
+    def transfer(self, dest, amt):
+        """Future of the transaction added to the local blockchain, fails with
+        ValueError if the amount is invalid or the balance is too low"""
+        data = self.client.transfer(dest, amt)
+        if data is None:
+            return completed(exception=ValueError("Cannot transfer {} from {}".format(amt, self.port)))
+        return completed(data)
+
+    def balance(self, account=None):
+        """Future of the balance as known to this node"""
+        with self.client.lock:
+            if account is None or str(account) == self.port:
+                return completed(self.client.balance)
+            return completed(self.client.find_client_balance(account))
+
+    def sync(self, dest=None):
+        """Send dest, or every peer, what it is missing. The Future has the size of each
+        frame sent once all of them are acknowledged, 0 for peers that were up to date.
+        Fails with ValueError if a peer dropped its frame"""
+        futures = []
+        for peer in [str(dest)] if dest is not None else list(self.client.outgoing_map):
+            waiter = Future()
+            if not self.client.sync(peer, waiter):
+                waiter.set_result(0)
+            futures.append(waiter)
+        return gather(futures)
@@ -0,0 +1,170 @@
+"""
+Request/response protocol between client.py and the centralized servers
+
+Every request starts with its type and a request id chosen by the client, and
+the reply to it carries the same id, so a client can keep many requests
+outstanding on one connection and match the replies in whatever order they
+come back. Replies carry a typed Status instead of a status string.
+
+Every account has a version that changes whenever its balance does. A TRV is a
+transfer that only goes through if the source account is still at the version
+the client last saw, otherwise it fails with CONFLICT, which lets clients submit
+without holding the distributed mutual exclusion (optimistic concurrency).
+
+    TRA  HEADER + TRANSFER             ->  REPLY + VERSION
+    TRV  HEADER + TRANSFER + VERSION   ->  REPLY + VERSION
+    BAL  HEADER + ACCOUNT              ->  REPLY + BALANCE
+    TRB  HEADER + COUNT + n*TRANSFER   ->  REPLY + COUNT + n status bytes + n*VERSION
+    SHD  HEADER                        ->  REPLY + SHARDS
+
+VERSION in a reply is the version of the source account after the request, a TRB
+reply has one for each transfer.
+
+SHD asks how the server splits the accounts. A server with one ledger answers 1
+shard and everything goes over the connection it was asked on. A sharded server
+answers the number of shards and the port of shard 0, shard i listens on that
+port + i and owns the accounts with account % shards == i. Requests whose
+accounts are all in one shard go straight to it, the rest to the server.
+
+A BAL reply also carries a lease, the number of seconds the client may keep
+answering reads of that account from its own cache instead of asking again.
+"""
+
+import struct
+from enum import IntEnum
+
+# type, request id
+HEADER = struct.Struct('<3sI')
+# src, dest, amt
+TRANSFER = struct.Struct('<iid')
+ACCOUNT = struct.Struct('<i')
+COUNT = struct.Struct('<I')
+# type, request id, status
+REPLY = struct.Struct('<3sIB')
+# balance, version, lease in seconds
+BALANCE = struct.Struct('<dQd')
+VERSION = struct.Struct('<Q')
+# number of shards, port of shard 0
+SHARDS = struct.Struct('<IH')
+
+TRANSFER_TYPE = b'TRA'
+TRANSFER_IF_TYPE = b'TRV'
+BALANCE_TYPE = b'BAL'
+BATCH_TYPE = b'TRB'
+SHARDS_TYPE = b'SHD'
+
+class Status(IntEnum):
+    OK = 0
+    INSUFFICIENT_FUNDS = 1
+    UNKNOWN_ACCOUNT = 2
+    INVALID_AMOUNT = 3
+    MALFORMED = 4
+    CONFLICT = 5
+    # the part of the server that owns the account is gone
+    UNAVAILABLE = 6
+
+class Reply:
+    def __init__(self, kind, request_id, status, balance=None, version=None, lease=0.0, statuses=None, versions=None):
+        self.kind = kind
+        self.request_id = request_id
+        self.status = status
+        # BAL only
+        self.balance = balance
+        # TRA, TRV and BAL
+        self.version = version
+        # BAL only, 0 if the reply must not be cached
+        self.lease = lease
+        # TRB only, one Status per transfer in the order they were sent
+        self.statuses = statuses
+        # TRB only, the version of the source account after each transfer
+        self.versions = versions
+        # SHD only
+        self.shards = None
+        self.port = None
+
+    def __repr__(self):
+        return "Reply({}, {}, {})".format(self.kind, self.request_id, self.status.name)
+
+def transfer_request(request_id, src, dest, amt, version=None):
+    """A TRA, or a TRV when the version of src the transfer was decided on is given"""
+    if version is None:
+        return HEADER.pack(TRANSFER_TYPE, request_id) + TRANSFER.pack(src, dest, amt)
+    return HEADER.pack(TRANSFER_IF_TYPE, request_id) + TRANSFER.pack(src, dest, amt) + VERSION.pack(version)
+
+def shard_of(account, shards):
+    return int(account) % shards
+
+def shards_request(request_id):
+    return HEADER.pack(SHARDS_TYPE, request_id)
+
+def balance_request(request_id, account):
+    return HEADER.pack(BALANCE_TYPE, request_id) + ACCOUNT.pack(account)
+
+def batch_request(request_id, transfers):
+    """transfers is a list of (src, dest, amt)"""
+    parts = [HEADER.pack(BATCH_TYPE, request_id), COUNT.pack(len(transfers))]
+    parts.extend(TRANSFER.pack(*transfer) for transfer in transfers)
+    return b''.join(parts)
+
+def parse_request(frame):
+    """Returns (type, request id, body) where body is (src, dest, amt, version) for TRA
+    and TRV, version being None for TRA, the account for BAL and a list of
+    (src, dest, amt) for TRB. Raises ValueError"""
+    if len(frame) < HEADER.size:
+        raise ValueError("Request too short")
+    kind, request_id = HEADER.unpack_from(frame)
+    offset = HEADER.size
+    if kind == TRANSFER_TYPE and len(frame) == offset + TRANSFER.size:
+        return kind, request_id, TRANSFER.unpack_from(frame, offset) + (None,)
+    if kind == TRANSFER_IF_TYPE and len(frame) == offset + TRANSFER.size + VERSION.size:
+        return kind, request_id, TRANSFER.unpack_from(frame, offset) + VERSION.unpack_from(frame, offset + TRANSFER.size)
+    if kind == BALANCE_TYPE and len(frame) == offset + ACCOUNT.size:
+        return kind, request_id, ACCOUNT.unpack_from(frame, offset)[0]
+    if kind == BATCH_TYPE and len(frame) >= offset + COUNT.size:
+        (count,) = COUNT.unpack_from(frame, offset)
+        offset += COUNT.size
+        if len(frame) == offset + count*TRANSFER.size:
+            return kind, request_id, list(TRANSFER.iter_unpack(frame[offset:]))
+    if kind == SHARDS_TYPE and len(frame) == offset:
+        return kind, request_id, None
+    raise ValueError("Malformed {} request {}".format(bytes(kind), request_id))
+
+def request_id_of(frame):
+    """Best effort id of a request that could not be parsed, so the error can be matched"""
+    if len(frame) < HEADER.size:
+        return 0
+    return HEADER.unpack_from(frame)[1]
+
+def status_reply(kind, request_id, status):
+    return REPLY.pack(kind, request_id, status)
+
+def transfer_reply(kind, request_id, status, version):
+    return REPLY.pack(kind, request_id, status) + VERSION.pack(version)
+
+def balance_reply(request_id, balance, version, lease=0.0, status=Status.OK):
+    return REPLY.pack(BALANCE_TYPE, request_id, status) + BALANCE.pack(balance, version, lease)
+
+def shards_reply(request_id, shards=1, port=0):
+    return REPLY.pack(SHARDS_TYPE, request_id, Status.OK) + SHARDS.pack(shards, port)
+
+def batch_reply(request_id, statuses, versions):
+    return (REPLY.pack(BATCH_TYPE, request_id, Status.OK) + COUNT.pack(len(statuses)) + bytes(statuses)
+            + b''.join(VERSION.pack(version) for version in versions))
+
+def parse_reply(frame):
+    kind, request_id, status = REPLY.unpack_from(frame)
+    reply = Reply(kind, request_id, Status(status))
+    offset = REPLY.size
+    if kind == BALANCE_TYPE and len(frame) >= offset + BALANCE.size:
+        reply.balance, reply.version, reply.lease = BALANCE.unpack_from(frame, offset)
+    elif kind in (TRANSFER_TYPE, TRANSFER_IF_TYPE) and len(frame) >= offset + VERSION.size:
+        (reply.version,) = VERSION.unpack_from(frame, offset)
+    elif kind == BATCH_TYPE and len(frame) >= offset + COUNT.size:
+        (count,) = COUNT.unpack_from(frame, offset)
+        offset += COUNT.size
+        reply.statuses = [Status(status) for status in bytes(frame[offset:offset+count])]
+        offset += count
+        reply.versions = [version for (version,) in VERSION.iter_unpack(frame[offset:offset+count*VERSION.size])]
+    elif kind == SHARDS_TYPE and len(frame) >= offset + SHARDS.size:
+        reply.shards, reply.port = SHARDS.unpack_from(frame, offset)
+    return reply
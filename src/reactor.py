@@ -0,0 +1,178 @@
+"""
+Reactor is a small event loop around the selectors module
+
+Sockets are registered with a callback which is dispatched only when they are
+ready, so the loop sleeps in epoll (or whatever the platform provides) instead
+of polling. Timers are kept in a heap and bound how long the loop sleeps.
+Frames queued with send() are written without blocking, the rest of a frame the
+socket cannot take yet is flushed when it becomes writable.
+"""
+
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from simple_socket import SimpleSocket, FRAME_HEADER, IOV_MAX
+
+class Reactor:
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+        # called after every batch of ready sockets has been handled
+        self.after_dispatch = []
+        # (deadline, sequence, callback), the sequence keeps equal deadlines in order
+        self.timers = []
+        self.sequence = itertools.count()
+        # callbacks handed over by other threads
+        self.ready = deque()
+        self.ready_lock = threading.Lock()
+        # socket -> deque of buffers queued with send() the socket has not taken yet
+        self.outgoing = {}
+        # writing to this pair wakes the loop up from another thread
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.register(self.wakeup_recv, self.handle_wakeup)
+
+    def register(self, sock, callback):
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+
+    def unregister(self, sock):
+        self.selector.unregister(sock)
+        self.outgoing.pop(sock, None)
+
+    def send(self, sock, *parts):
+        """Queue one frame whose payload is the concatenation of parts. sock must be
+        non-blocking and registered with add_connection, only call from the loop thread"""
+        buffers = self.outgoing.get(sock)
+        if buffers is None:
+            buffers = self.outgoing[sock] = deque()
+        idle = not buffers
+        views = [memoryview(part).cast('B') for part in parts]
+        buffers.append(memoryview(FRAME_HEADER.pack(sum(len(view) for view in views))))
+        # empty payloads would never leave the queue
+        buffers.extend(view for view in views if len(view))
+        if idle:
+            self.flush(sock)
+
+    def flush(self, sock):
+        buffers = self.outgoing.get(sock)
+        if buffers is None:
+            return
+        try:
+            while buffers:
+                sent = sock.socket.sendmsg(list(itertools.islice(buffers, IOV_MAX)))
+                while sent:
+                    if sent >= len(buffers[0]):
+                        sent -= len(buffers.popleft())
+                    else:
+                        buffers[0] = buffers[0][sent:]
+                        sent = 0
+        except BlockingIOError:
+            pass
+        except OSError:
+            # the read side sees the connection go away and closes it
+            logging.warning("Dropping {} unsent buffers for fd {}".format(len(buffers), sock.fileno()))
+            buffers.clear()
+        key = self.selector.get_map().get(sock)
+        if key is None:
+            return
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if buffers else selectors.EVENT_READ
+        if key.events != events:
+            self.selector.modify(sock, events, key.data)
+
+    def add_listener(self, listener, on_accept):
+        """on_accept(sock, addr) is called with a SimpleSocket for every new connection"""
+        def accept(_):
+            sockfd, addr = listener.socket.accept()
+            on_accept(SimpleSocket(sock=sockfd), addr)
+        self.register(listener, accept)
+
+    def add_connection(self, sock, on_frame, on_close):
+        """on_frame(sock, frame) is called for every frame, on_close(sock) once the peer goes away"""
+        def read(_):
+            try:
+                frames = sock.receive_available()
+                broken = False
+            except BlockingIOError:
+                # woken up with nothing to read
+                return
+            except OSError:
+                # reset by the peer or closed under us, either way the connection is gone
+                frames = []
+                broken = True
+            for frame in frames:
+                try:
+                    on_frame(sock, frame)
+                except Exception:
+                    logging.exception("Error while handling a message from fd {}".format(sock.fileno()))
+            if broken or sock.closed:
+                self.unregister(sock)
+                on_close(sock)
+        self.register(sock, read)
+
+    def call_later(self, delay, callback):
+        """Run callback on the loop after delay seconds, only call from the loop thread"""
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.sequence), callback))
+
+    def call_soon_threadsafe(self, callback):
+        with self.ready_lock:
+            self.ready.append(callback)
+        self.wakeup_send.send(b'\0')
+
+    def timeout(self):
+        if self.ready:
+            return 0
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - time.monotonic())
+
+    def run_callbacks(self):
+        with self.ready_lock:
+            callbacks = list(self.ready)
+            self.ready.clear()
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            callbacks.append(heapq.heappop(self.timers)[2])
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.exception("Error in {}".format(callback))
+
+    def handle_wakeup(self, sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        self.running = True
+        while self.running:
+            for key, events in self.selector.select(self.timeout()):
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        self.flush(key.fileobj)
+                    if events & selectors.EVENT_READ:
+                        key.data(key.fileobj)
+                except Exception:
+                    logging.exception("Error while handling {}".format(key.fileobj))
+            self.run_callbacks()
+            for callback in self.after_dispatch:
+                try:
+                    callback()
+                except Exception:
+                    logging.exception("Error in {}".format(callback))
+
+    def stop(self):
+        self.running = False
+        self.wakeup_send.send(b'\0')
+
+    def close(self):
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
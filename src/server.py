@@ -1,75 +1,46 @@
-import sys
+import argparse
 import logging
-import threading
 import socket
 import time
-import select
-import re
-import struct
+import asyncio
 from simple_socket import SimpleSocket
+from reactor import Reactor
+import protocol
+from ledger import open_ledger, read_balance, Snapshot
+from mempool import Mempool
+from async_server import AsyncServer
+from sharded_server import ShardedServer
 
 CONFIG_FILE = 'config.cfg'
-
-class Node:
-    def __init__(self, data=None, next=None, prev=None):
-        self.data = data
-        # data = {
-        #    'type': "TRA",
-        #    'src' : 8000,
-        #    'dest': 8001,
-        #    'amt': 5    
-        # }
-        self.next = next
-        self.prev = prev
-
-    def __repr__(self):
-        return str(self.data)
-
-class LinkedList:
-    def __init__(self):
-        self.head = None
-
-    def prepend(self, data):
-        new_head = Node(data=data, next=self.head)
-        if self.head:
-            self.head.prev = new_head
-        self.head = new_head
-
-    def append(self, data):
-        if not self.head:
-            self.head = Node(data=data)
-            return
-        curr = self.head
-        while curr.next:
-            curr = curr.next
-        curr.next = Node(data=data, prev=curr)
+LEDGER_FILE = 'ledger.dat'
+SERVER_PORT = 5535
 
 class Server:
-    def __init__(self):
-        self.listener = SimpleSocket(listener=True, bind_addr=('0.0.0.0'), bind_port=5535)
+    def __init__(self, ledger_path=None, checkpoint_interval=1024, port=SERVER_PORT, config=CONFIG_FILE, lease=0.0,
+                 block_transactions=1024, block_bytes=1 << 20, block_delay=0.0):
+        self.listener = SimpleSocket(listener=True, bind_addr=('0.0.0.0'), bind_port=port)
         self.listener.bind()
         self.listener.socket.listen(5)
         logging.debug("Listening socket bound to {}".format(self.listener.bind_address_port))
-        self.blockchain = LinkedList()
         self.clients = []
         self.incoming_map = {}
         self.outgoing_map = {}
-        self.socket_list = [self.listener.socket]
-        with open(CONFIG_FILE, 'r') as f:
+        self.reactor = Reactor()
+        self.reactor.after_dispatch.append(self.commit)
+        with open(config, 'r') as f:
             for line in f:
                 line = line.strip()
                 logging.debug("Adding client {} to the list".format(line))
                 self.clients.append(line)
+        self.ledger = open_ledger(self.clients, ledger_path, checkpoint_interval, lease)
+        # replies held back until the blocks they acknowledge are on disk
+        self.mempool = Mempool(self.ledger, block_transactions, block_bytes, block_delay)
+        # state as of the last block, balance reads are answered from it
+        self.snapshot = Snapshot(self.ledger)
 
     def init_blockchain(self):
-        for client in self.clients:
-            data = {
-                'type': "INIT",
-                'src': 0,
-                'dest': int(client),
-                'amt': 10.0
-            }
-            self.blockchain.append(data)
+        self.ledger.init_blockchain()
+        self.snapshot = Snapshot(self.ledger)
 
     def cleanup(self):
         for client in self.clients:
@@ -86,102 +57,93 @@ class Server:
 
 
     def handle_connections(self):
+        self.reactor.add_listener(self.listener, self.accept_connection)
         try:
-            while 1:
-                read, _, _ = select.select(self.socket_list, [], [], 0)
-                for sock in read:
-                    if sock == self.listener.socket:
-                        sockfd, addr = self.listener.socket.accept()
-                        self.socket_list.append(sockfd)
-                        logging.info("Accepted new connection from {}".format(addr))
-                    else:
-                        try:
-                            message = sock.recv(1024)
-                            logging.debug("{} - {}".format(sock.getpeername(), message))
-                            if re.match("[0-9]+", message.decode('utf-8').strip()):
-                                self.incoming_map[sock] = message.decode('utf-8').strip()
-                                self.outgoing_map[message.decode('utf-8').strip()] = sock
-                                logging.debug("{} = {}".format(message.decode('utf-8').strip(), sock.getpeername()))
-                            elif message==b'':
-                                sock.shutdown(socket.SHUT_RDWR)
-                                sock.close()
-                                self.socket_list.remove(sock)
-                                client = self.incoming_map[sock]
-                                del(self.incoming_map[sock])
-                                del(self.outgoing_map[client])
-                            else:
-                                client = self.incoming_map[sock]
-                                self.handle_transaction(message, client)
-                        except Exception:
-                            logging.exception("Error while trying to read form incoming sockets")
-                time.sleep(0.1)
+            self.reactor.run()
         except KeyboardInterrupt:
             self.cleanup()
             logging.exception("Error")
             return
 
-    def check_transaction_validity(self, message_tuple):
-        client_balance = {0:30.0}
-        # Initialise initial balance
-        for client in self.clients:
-            client_balance[int(client)] = 0.0
-        # iterate through the blockchain to see the balance of each client at the last block
-        curr = self.blockchain.head
-        while curr:
-            data = curr.data
-            src = data['src']
-            dest = data['dest']
-            amt = data['amt']
-            client_balance[src] -= amt
-            client_balance[dest] +=amt
-            curr = curr.next
-        message_type = message_tuple[0].decode('utf-8').strip()
-        src = message_tuple[1]
-        dest = message_tuple[2]
-        amt = message_tuple[3]
-        logging.debug("Balance vector = {}".format(client_balance))
-        if message_type == "BAL":
-            return client_balance[message_tuple[1]]
-        elif message_type == "TRA":
-            if amt<=client_balance[src]:
-                return "VALID"
-            else:
-                return "INVALID"
+    def accept_connection(self, sock, addr):
+        logging.info("Accepted new connection from {}".format(addr))
+        self.reactor.add_connection(sock, self.handle_frame, self.close_connection)
+
+    def handle_frame(self, sock, message):
+        logging.debug("{} - {}".format(sock.socket.getpeername(), bytes(message)))
+        if sock not in self.incoming_map:
+            # the first frame on every connection is the port of the client
+            client = bytes(message).decode('utf-8').strip()
+            self.incoming_map[sock] = client
+            self.outgoing_map[client] = sock
+            logging.debug("{} = {}".format(client, sock.socket.getpeername()))
+        else:
+            client = self.incoming_map[sock]
+            self.handle_transaction(message, client)
+
+    def close_connection(self, sock):
+        try:
+            sock.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # the peer may already have torn the connection down
+            pass
+        sock.close()
+        client = self.incoming_map.pop(sock, None)
+        if client is not None:
+            del(self.outgoing_map[client])
 
     def handle_transaction(self, message, client):
-        message_tuple = struct.unpack('3siii', message)
-        message_type = message_tuple[0].decode('utf-8').strip()
-        logging.debug("Message tuple = {}".format(message_tuple))
-        src = message_tuple[1]
-        dest = message_tuple[2]
-        amt = message_tuple[3]
-        status = self.check_transaction_validity(message_tuple)
-        logging.debug("Transaction status: {}".format(status))
-        if message_type == "TRA":
-            if status == "VALID":
-                data = {
-                    'type': 'TRA',
-                    'src': src,
-                    'dest': dest,
-                    'amt': amt
-                }
-                self.blockchain.append(data)
-                status_msg = struct.pack('9s', bytes("SUCCESS", 'utf-8'))
-                logging.debug("Sending SUCCESS to {}".format(src))
-                self.outgoing_map[str(src)].send(bytes(status_msg))
-            else:
-                status_msg = struct.pack('9s', bytes("INCORRECT", 'utf-8'))
-                logging.debug("Sending INCORRECT to {}".format(src))
-                self.outgoing_map[str(src)].send(bytes(status_msg))
-        elif message_type == "BAL":
-            status_msg = struct.pack('7sf', bytes("BALANCE", 'utf-8'), status)
-            logging.debug("Sending balance to {}".format(src))
-            self.outgoing_map[str(src)].send(bytes(status_msg))
+        # replies go back on the connection the request came in on, matched by request id
+        if bytes(message[:3]) == protocol.SHARDS_TYPE:
+            self.outgoing_map[client].send(protocol.shards_reply(protocol.request_id_of(message)))
+            return
+        if bytes(message[:3]) == protocol.BALANCE_TYPE:
+            # reads do not wait for the next block
+            self.outgoing_map[client].send(read_balance(self.snapshot, message))
+            return
+        _, status_msg = self.ledger.execute(message)
+        first = not self.mempool
+        self.mempool.add(client, status_msg, len(message))
+        if self.mempool.full():
+            self.commit()
+        elif first:
+            # the rest are sealed at the end of the round, or when the oldest has waited long enough
+            self.reactor.call_later(self.mempool.deadline() - time.monotonic(), self.commit)
+
+    def commit(self):
+        # group commit: one block and one fsync for everything in the mempool, then the replies
+        if not self.mempool.due():
+            return
+        self.ledger.commit()
+        self.snapshot = Snapshot(self.ledger)
+        replies = {}
+        for src, status_msg in self.mempool.take():
+            replies.setdefault(src, []).append(status_msg)
+        for src, messages in replies.items():
+            sock = self.outgoing_map.get(src)
+            if sock:
+                sock.send_many(messages)
 
 
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Centralized blockchain server")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="use the asyncio server")
+    parser.add_argument('--shards', type=int, default=1, help="split the accounts over this many worker processes")
+    parser.add_argument('--ledger', default=LEDGER_FILE, help="append-only file the blockchain is kept in")
+    parser.add_argument('--in-memory', action='store_true', help="do not persist the blockchain")
+    parser.add_argument('--checkpoint-interval', type=int, default=1024, help="blocks between balance checkpoints")
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--config', default=CONFIG_FILE, help="file listing the client ports")
+    parser.add_argument('--lease', type=float, default=0.5, help="seconds clients may cache a balance, 0 to turn caching off")
+    parser.add_argument('--block-transactions', type=int, default=1024, help="seal a block once it holds this many transactions")
+    parser.add_argument('--block-bytes', type=int, default=1 << 20, help="seal a block once its requests add up to this many bytes")
+    parser.add_argument('--block-delay', type=float, default=0.0,
+                        help="seal a block once its oldest transaction has waited this many seconds, 0 seals when no requests are left to read")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='DEBUG')
+    args = parser.parse_args()
+
     # Logging Configuration
 
     logging.basicConfig(
@@ -189,13 +151,29 @@ if __name__ == "__main__":
             logging.FileHandler("Server.log"),
             logging.StreamHandler()
         ],
-        level=logging.DEBUG,
+        level=getattr(logging, args.log_level),
         format='%(asctime)s - [%(levelname)s]: %(message)s', datefmt="%Y-%m-%d %H:%M:%S %z"
         )
-    logging.info("Starting Client")
-    c = Server()
-    c.init_blockchain()
-    c.handle_connections()
+    ledger_path = None if args.in_memory else args.ledger
+    if args.shards > 1:
+        logging.info("Starting Server with {} shards".format(args.shards))
+        c = ShardedServer(args.shards, bind_port=args.port, ledger_path=ledger_path, config=args.config,
+                          checkpoint_interval=args.checkpoint_interval, lease=args.lease,
+                          block_transactions=args.block_transactions, block_bytes=args.block_bytes, block_delay=args.block_delay)
+        c.init_blockchain()
+        asyncio.run(c.serve())
+    elif args.use_async:
+        logging.info("Starting asyncio Server")
+        c = AsyncServer(bind_port=args.port, ledger_path=ledger_path, checkpoint_interval=args.checkpoint_interval, config=args.config, lease=args.lease,
+                        block_transactions=args.block_transactions, block_bytes=args.block_bytes, block_delay=args.block_delay)
+        c.init_blockchain()
+        asyncio.run(c.serve())
+    else:
+        logging.info("Starting Server")
+        c = Server(ledger_path=ledger_path, checkpoint_interval=args.checkpoint_interval, port=args.port, config=args.config, lease=args.lease,
+                   block_transactions=args.block_transactions, block_bytes=args.block_bytes, block_delay=args.block_delay)
+        c.init_blockchain()
+        c.handle_connections()
 
 
 
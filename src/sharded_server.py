@@ -0,0 +1,334 @@
+"""
+ShardedServer spreads the centralized ledger over several worker processes
+
+Accounts are partitioned by account % shards. Every shard is a worker process
+with its own ledger, balances, mempool and files (ledger.dat.shard<i>), served
+by the asyncio server code. Shard i listens for clients on the router's port +
+1 + i. Clients ask the router for the number of shards with an SHD request (see
+protocol) and send every BAL, and every TRA, TRV or TRB whose accounts are all
+in one shard, straight to the owning shard. Those never pass through the
+router. It only takes the requests that span shards, and whatever a client
+sends it that a shard could have answered, which it passes on over a socket
+pair. Throughput can grow with the shards only while each has a core, and the
+transfers between shards, which cost the router and two round trips to each
+of their shards, set the ceiling.
+
+A transfer between shards is committed with two-phase commit (2PC), using the
+router as coordinator:
+
+    prepare  PRD to the shard of src: check the transfer and hold amt of src
+             PRC to the shard of dest: check that dest exists
+    commit   CMT to both once both voted OK, ABT to those that did otherwise
+
+On commit, the shard of src appends src -> ESCROW and the shard of dest appends
+ESCROW -> dest. Both halves carry the transaction id in local_time, so they can
+be matched. Held amounts are not spendable, so local transfers can run while a
+2PC is in flight without a lock. The coordinator does not log its decisions.
+If the router dies between the two commits, that transfer is left half done.
+
+Usage: python server.py --shards N
+"""
+
+import asyncio
+import itertools
+import logging
+import math
+import multiprocessing
+import socket
+import struct
+import protocol
+from protocol import Status, HEADER, REPLY, VERSION, shard_of
+from ledger import Ledger
+from async_server import AsyncServer, read_frame, write_frame
+
+CONFIG_FILE = 'config.cfg'
+
+# the mint account every ledger starts from, present in every shard
+ESCROW = 0
+
+PREPARE_DEBIT_TYPE = b'PRD'
+PREPARE_CREDIT_TYPE = b'PRC'
+COMMIT_TYPE = b'CMT'
+ABORT_TYPE = b'ABT'
+TWO_PHASE_TYPES = (PREPARE_DEBIT_TYPE, PREPARE_CREDIT_TYPE, COMMIT_TYPE, ABORT_TYPE)
+# transaction id, src, dest, amt, whether version is set, version
+PREPARE = struct.Struct('<Qiid?Q')
+TXID = struct.Struct('<Q')
+REQUEST_ID = struct.Struct('<I')
+# sent by a shard to the router once it listens for clients
+READY = b'RDY'
+
+def prepare_request(kind, request_id, txid, src, dest, amt, version=None):
+    return HEADER.pack(kind, request_id) + PREPARE.pack(txid, src, dest, amt, version is not None, version or 0)
+
+def decision_request(kind, request_id, txid):
+    return HEADER.pack(kind, request_id) + TXID.pack(txid)
+
+class ShardLedger(Ledger):
+    """Ledger of the accounts of one shard, which also takes part in 2PC"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # account -> amount promised to prepared transfers to other shards
+        self.held = {}
+        # transaction id -> (kind, account, amt) of every prepared transfer
+        self.prepared = {}
+
+    def check_transfer(self, src, dest, amt):
+        status = super().check_transfer(src, dest, amt)
+        if status == Status.OK and amt > self.balances[src] - self.held.get(src, 0.0):
+            return Status.INSUFFICIENT_FUNDS
+        return status
+
+    def prepare(self, kind, txid, src, dest, amt, version):
+        if kind == PREPARE_CREDIT_TYPE:
+            if dest not in self.balances:
+                return dest, Status.UNKNOWN_ACCOUNT
+            if not math.isfinite(amt) or amt < 0:
+                return dest, Status.INVALID_AMOUNT
+            self.prepared[txid] = (kind, dest, amt)
+            return dest, Status.OK
+        if version is not None and src in self.balances and version != self.version(src):
+            return src, Status.CONFLICT
+        # dest is checked by its own shard
+        status = self.check_transfer(src, ESCROW, amt)
+        if status == Status.OK:
+            self.held[src] = self.held.get(src, 0.0) + amt
+            self.prepared[txid] = (kind, src, amt)
+        return src, status
+
+    def decide(self, kind, txid):
+        if txid not in self.prepared:
+            return ESCROW, Status.MALFORMED
+        prepared, account, amt = self.prepared.pop(txid)
+        if prepared == PREPARE_DEBIT_TYPE:
+            self.held[account] -= amt
+            if not self.held[account]:
+                del self.held[account]
+        if kind == COMMIT_TYPE:
+            if prepared == PREPARE_DEBIT_TYPE:
+                self.append_block({'type': 'TRA', 'src': account, 'dest': ESCROW, 'amt': amt, 'local_time': txid})
+            else:
+                self.append_block({'type': 'TRA', 'src': ESCROW, 'dest': account, 'amt': amt, 'local_time': txid})
+        return account, Status.OK
+
+    def execute(self, message):
+        kind = bytes(message[:3])
+        if kind not in TWO_PHASE_TYPES:
+            return super().execute(message)
+        _, request_id = HEADER.unpack_from(message)
+        try:
+            if kind in (PREPARE_DEBIT_TYPE, PREPARE_CREDIT_TYPE):
+                txid, src, dest, amt, checked, version = PREPARE.unpack_from(message, HEADER.size)
+                account, status = self.prepare(kind, txid, src, dest, amt, version if checked else None)
+            else:
+                (txid,) = TXID.unpack_from(message, HEADER.size)
+                account, status = self.decide(kind, txid)
+        except struct.error:
+            logging.exception("Dropping malformed request")
+            return None, protocol.status_reply(kind, request_id, Status.MALFORMED)
+        logging.debug("{} of {} on {}: {}".format(kind, txid, account, status.name))
+        return account, protocol.transfer_reply(kind, request_id, status, self.version(account))
+
+class Shard(AsyncServer):
+    """One worker process, serving the router over a socket pair and clients on its own port"""
+    def __init__(self, index, clients, ledger_path=None, **options):
+        super().__init__(ledger_path=ledger_path, clients=clients, ledger_class=ShardLedger, **options)
+        self.index = index
+        # client connection -> the task serving it
+        self.connections = {}
+
+    async def handle_client(self, reader, writer):
+        self.connections[writer] = asyncio.current_task()
+        try:
+            await super().handle_client(reader, writer)
+        finally:
+            self.connections.pop(writer, None)
+
+    async def serve_router(self, sock):
+        self.pending = asyncio.Queue()
+        writer_task = asyncio.create_task(self.apply_transactions())
+        server = await asyncio.start_server(self.handle_client, *self.bind_address_port)
+        logging.debug("Shard {} listening on {}".format(self.index, self.bind_address_port))
+        try:
+            # the shard lives as long as the router
+            async with server:
+                reader, writer = await asyncio.open_connection(sock=sock)
+                # the router waits for this before letting clients in
+                write_frame(writer, READY)
+                await self.handle_client(reader, writer)
+                # let the clients see the connection close rather than cancelling them
+                tasks = list(self.connections.values())
+                for client in list(self.connections):
+                    client.close()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer_task.cancel()
+
+def run_shard(index, sock, clients, ledger_path, options, inherited):
+    # the router's ends of our connection and of those of the shards forked before
+    # us, the router could never close them while we hold them
+    for other in inherited:
+        other.close()
+    shard = Shard(index, clients, ledger_path, **options)
+    shard.init_blockchain()
+    logging.info("Shard {} serving accounts {}".format(index, clients))
+    asyncio.run(shard.serve_router(sock))
+
+class ShardedServer(AsyncServer):
+    """Router in front of the shards, speaks the client protocol"""
+    def __init__(self, shards, bind_addr='0.0.0.0', bind_port=5535, ledger_path=None, config=CONFIG_FILE, **options):
+        self.bind_address_port = (bind_addr, bind_port)
+        self.clients = []
+        with open(config, 'r') as f:
+            for line in f:
+                line = line.strip()
+                logging.debug("Adding client {} to the list".format(line))
+                self.clients.append(line)
+        self.accounts = set(int(client) for client in self.clients)
+        self.shards = shards
+        self.ledger_path = ledger_path
+        self.options = options
+        self.processes = []
+        self.sockets = []
+        # per shard stream writer, and per shard router request id -> Future of the shard's reply
+        self.writers = []
+        self.waiting = [{} for _ in range(shards)]
+        # shards whose connection has closed, whatever is sent to them is answered UNAVAILABLE
+        self.gone = set()
+        self.request_ids = itertools.count(1)
+        self.txids = itertools.count(1)
+
+    def init_blockchain(self):
+        """Start the worker processes, each one recovers or initializes its own ledger"""
+        for index in range(self.shards):
+            clients = [client for client in self.clients if shard_of(client, self.shards) == index]
+            path = "{}.shard{}".format(self.ledger_path, index) if self.ledger_path else None
+            parent, child = socket.socketpair()
+            options = dict(self.options, bind_addr=self.bind_address_port[0], bind_port=self.shard_port(index))
+            process = multiprocessing.Process(target=run_shard, args=(index, child, clients, path, options, self.sockets + [parent]))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.processes.append(process)
+            self.sockets.append(parent)
+
+    def shard_port(self, index):
+        return self.bind_address_port[1] + 1 + index
+
+    async def serve(self):
+        readers = []
+        for index, sock in enumerate(self.sockets):
+            reader, writer = await asyncio.open_connection(sock=sock)
+            write_frame(writer, bytes("shard{}".format(index), 'UTF-8'))
+            # clients connect to the shards as soon as we listen
+            await read_frame(reader)
+            self.writers.append(writer)
+            readers.append(asyncio.create_task(self.read_replies(index, reader)))
+        server = await asyncio.start_server(self.handle_client, *self.bind_address_port)
+        logging.debug("Listening socket bound to {}".format(self.bind_address_port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in readers:
+                task.cancel()
+            for writer in self.writers:
+                writer.close()
+            for process in self.processes:
+                process.join()
+
+    async def read_replies(self, index, reader):
+        try:
+            while True:
+                reply = await read_frame(reader)
+                (request_id,) = REQUEST_ID.unpack_from(reply, 3)
+                future = self.waiting[index].pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logging.error("Shard {} closed its connection".format(index))
+            self.gone.add(index)
+            waiting, self.waiting[index] = self.waiting[index], {}
+            for future in waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Shard {} is gone".format(index)))
+
+    def home(self, src, dest):
+        """The shard a transfer runs on, None if it needs two-phase commit"""
+        home = shard_of(src, self.shards)
+        if src in self.accounts and dest in self.accounts and shard_of(dest, self.shards) != home:
+            return None
+        # one shard, which also turns down accounts it does not have
+        return home
+
+    async def call(self, shard, build):
+        """Send the request build(request_id) returns to a shard, returns its reply frame"""
+        if shard in self.gone:
+            raise ConnectionError("Shard {} is gone".format(shard))
+        request_id = next(self.request_ids) & 0xffffffff
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[shard][request_id] = future
+        write_frame(self.writers[shard], build(request_id))
+        return await future
+
+    async def handle_transaction(self, message):
+        try:
+            kind, request_id, body = protocol.parse_request(message)
+        except ValueError:
+            logging.exception("Dropping malformed request")
+            return protocol.status_reply(bytes(message[:3]), protocol.request_id_of(message), Status.MALFORMED)
+        if kind == protocol.SHARDS_TYPE:
+            return protocol.shards_reply(request_id, self.shards, self.shard_port(0))
+        try:
+            if kind == protocol.BALANCE_TYPE:
+                reply = protocol.parse_reply(await self.call(shard_of(body, self.shards),
+                                                             lambda shard_id: protocol.balance_request(shard_id, body)))
+                return protocol.balance_reply(request_id, reply.balance or 0.0, reply.version or 0, reply.lease, reply.status)
+            if kind == protocol.BATCH_TYPE:
+                return protocol.batch_reply(request_id, *await self.batch(body))
+            status, version = await self.transfer(*body)
+            return protocol.transfer_reply(kind, request_id, status, version)
+        except ConnectionError:
+            logging.exception("Cannot answer {} request {}".format(kind, request_id))
+            return protocol.status_reply(kind, request_id, Status.UNAVAILABLE)
+
+    async def transfer(self, src, dest, amt, version=None):
+        """Returns the status of the transfer and the version of src after it"""
+        home = self.home(src, dest)
+        if home is None:
+            return await self.two_phase(src, dest, amt, version)
+        reply = protocol.parse_reply(await self.call(home, lambda shard_id: protocol.transfer_request(shard_id, src, dest, amt, version)))
+        return reply.status, reply.version
+
+    async def batch(self, transfers):
+        """Returns the status of every transfer and the version of its src after it"""
+        shards = set(shard_of(account, self.shards) for transfer in transfers for account in transfer[:2])
+        if len(shards) == 1:
+            reply = protocol.parse_reply(await self.call(shards.pop(), lambda shard_id: protocol.batch_request(shard_id, transfers)))
+            return reply.statuses, reply.versions
+        # each transfer sees the effect of the ones before it
+        statuses = []
+        versions = []
+        for src, dest, amt in transfers:
+            status, version = await self.transfer(src, dest, amt)
+            statuses.append(status)
+            versions.append(version)
+        return statuses, versions
+
+    async def two_phase(self, src, dest, amt, version):
+        txid = next(self.txids)
+        shards = (shard_of(src, self.shards), shard_of(dest, self.shards))
+        votes = await asyncio.gather(*[
+            self.call(shard, lambda shard_id, kind=kind: prepare_request(kind, shard_id, txid, src, dest, amt, version))
+            for shard, kind in zip(shards, (PREPARE_DEBIT_TYPE, PREPARE_CREDIT_TYPE))])
+        votes = [(REPLY.unpack_from(vote)[2], VERSION.unpack_from(vote, REPLY.size)[0]) for vote in votes]
+        decision = COMMIT_TYPE if all(status == Status.OK for status, _ in votes) else ABORT_TYPE
+        # only shards that voted OK hold anything
+        decided = [shard for shard, (status, _) in zip(shards, votes) if status == Status.OK]
+        replies = await asyncio.gather(*[self.call(shard, lambda shard_id: decision_request(decision, shard_id, txid))
+                                         for shard in decided])
+        if decision == ABORT_TYPE:
+            status = next(status for status, _ in votes if status != Status.OK)
+            return Status(status), votes[0][1]
+        # the version of src after its half was appended
+        return Status.OK, VERSION.unpack_from(replies[0], REPLY.size)[0]
@@ -1,18 +1,30 @@
 """
 SimpleSocket is a wrapper around the socket library
 
+Messages are sent as length-prefixed frames: a 4 byte big-endian length followed
+by the payload. FrameReader reassembles them from whatever the stream delivers,
+so a single recv may yield several frames or only part of one.
+
 Author: Rakshith G (hehaichi@gmail.com)
 """
 
+import os
 import socket
+import struct
 from functools import wraps
 
+FRAME_HEADER = struct.Struct('!I')
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
 def check_listener(f):
     """Decorator to check if the function is run on a listener type socket"""
     @wraps(f)
-    def check(self):
+    def check(self, *args, **kwargs):
         if self.listener:
-            return f(self)
+            return f(self, *args, **kwargs)
         else:
             raise AttributeError('Cannot call {} on non-listening socket'.format(f.__name__))
     return check
@@ -20,36 +32,172 @@ def check_listener(f):
 def check_non_listener(f):
     """Check if f is run on a non-listener socket"""
     @wraps(f)
-    def check(self):
+    def check(self, *args, **kwargs):
         if not self.listener:
-            return f(self)
+            return f(self, *args, **kwargs)
         else:
             raise AttributeError('Cannot call {} on listening socket'.format(f.__name__))
     return check
 
+def sendmsg_all(sock, buffers):
+    """Write all buffers with vectored sendmsg calls, resuming after partial writes"""
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+    buffers = [memoryview(b).cast('B') for b in buffers]
+    first = 0
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first:first+IOV_MAX])
+        while sent:
+            if sent >= len(buffers[first]):
+                sent -= len(buffers[first])
+                first += 1
+            else:
+                buffers[first] = buffers[first][sent:]
+                sent = 0
+        # skip empty payloads so they don't spin the loop
+        while first < len(buffers) and not len(buffers[first]):
+            first += 1
+
+def send_frame(sock, *parts):
+    """Send one frame whose payload is the concatenation of parts"""
+    length = sum(memoryview(part).nbytes for part in parts)
+    sendmsg_all(sock, (FRAME_HEADER.pack(length),) + parts)
+
+def send_frames(sock, frames):
+    """Send many frames with as few system calls as possible"""
+    buffers = []
+    for frame in frames:
+        buffers.append(FRAME_HEADER.pack(memoryview(frame).nbytes))
+        buffers.append(frame)
+    sendmsg_all(sock, buffers)
+
+class FrameReader:
+    """Reassembles frames from a stream socket into a reusable buffer
+
+    Frames are returned as memoryviews into the buffer. They stay valid until the
+    next call to fill(), so callers must consume or copy them before reading again.
+    """
+    def __init__(self, sock, size=65536):
+        self.socket = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.closed = False
+
+    def _make_room(self, needed):
+        pending = self.end - self.start
+        if needed > len(self.buffer):
+            # frame bigger than the buffer, move to a larger one
+            buffer = bytearray(max(needed, 2*len(self.buffer)))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start:
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def fill(self):
+        """Do a single recv_into and return the number of bytes read, 0 on EOF"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        # only compact here, frames handed out before this call may still point
+        # into the part of the buffer that gets overwritten
+        pending = self.end - self.start
+        needed = FRAME_HEADER.size
+        if pending >= FRAME_HEADER.size:
+            needed += FRAME_HEADER.unpack_from(self.buffer, self.start)[0]
+        if self.start + needed > len(self.buffer) or self.end == len(self.buffer):
+            self._make_room(max(needed, pending + 1))
+        n = self.socket.recv_into(self.view[self.end:])
+        if n == 0:
+            self.closed = True
+        self.end += n
+        return n
+
+    def next_frame(self):
+        """Return the next complete frame in the buffer or None"""
+        available = self.end - self.start
+        if available < FRAME_HEADER.size:
+            return None
+        (length,) = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        total = FRAME_HEADER.size + length
+        if available < total:
+            return None
+        begin = self.start + FRAME_HEADER.size
+        self.start += total
+        return self.view[begin:self.start]
+
+    def frames(self):
+        """Return every complete frame in the buffer"""
+        frames = []
+        frame = self.next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.next_frame()
+        return frames
+
+    def read_frame(self):
+        """Block until a complete frame is available"""
+        frame = self.next_frame()
+        while frame is None:
+            if not self.fill():
+                raise ConnectionError('Connection closed by peer')
+            frame = self.next_frame()
+        return frame
+
 class SimpleSocket:
-    def __init__(self, listener=False, **kwargs):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    def __init__(self, listener=False, sock=None, **kwargs):
+        if sock is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            # wrap an already connected socket, like the ones returned by accept()
+            self.socket = sock
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.listener = listener
         if self.listener:
             self.bind_address_port = (kwargs.get('bind_addr'), int(kwargs.get('bind_port')))
         else:
-            self.destination = (kwargs.get('dest_addr'), int(kwargs.get('dest_port')))
+            if sock is None:
+                self.destination = (kwargs.get('dest_addr'), int(kwargs.get('dest_port')))
+            self.reader = FrameReader(self.socket)
+
+    def fileno(self):
+        return self.socket.fileno()
 
     @check_listener
     def bind(self):
         self.socket.bind(self.bind_address_port)
-    
+
     @check_non_listener
     def connect(self):
         self.socket.connect(self.destination)
-    
-    def send(self, message):
-        self.socket.send(message)
-    
+
+    def close(self):
+        self.socket.close()
+
+    @check_non_listener
+    def send(self, *parts):
+        send_frame(self.socket, *parts)
+
+    @check_non_listener
+    def send_many(self, messages):
+        send_frames(self.socket, messages)
+
+    @check_non_listener
     def receive(self):
-        message = self.socket.recv(1024)
-        return message
+        return self.reader.read_frame()
+
+    @check_non_listener
+    def receive_available(self):
+        """Read once from the socket and return all the frames that are now complete.
+        An empty list with self.closed set means the peer closed the connection"""
+        self.reader.fill()
+        return self.reader.frames()
 
+    @property
+    def closed(self):
+        return self.reader.closed
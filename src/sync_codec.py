@@ -0,0 +1,164 @@
+"""
+Wire format of the sync messages exchanged by replicated nodes
+
+A sync carries the transactions a peer is missing, grouped into one run per
+origin as EventLog hands them out, followed by the sender's time table:
+
+    header   HEADER: marker, version, codec, time table dimension,
+             number of transactions, size of the varint section
+    varints  number of runs, (origin, count) of every run, then one column of
+             local_time deltas (from the previous transaction of the same run)
+             and one column of zigzag encoded dest - src
+    amounts  float64 per transaction
+    tt       int64 per time table cell
+
+Inside a run src is implied and local_time only grows, so most transactions
+take a few bytes instead of 16. Bodies above a threshold can additionally be
+compressed with zlib or lzma. Both directions are vectorized with NumPy, the
+decoder returns whole columns and never builds per-transaction tuples.
+"""
+
+import lzma
+import struct
+import zlib
+import numpy as np
+
+VERSION = 1
+# marker, version, codec, dimension of the time table, number of transactions, size of the varints
+HEADER = struct.Struct('<cBBIII')
+MARKER = b'W'
+CODECS = {'none': 0, 'zlib': 1, 'lzma': 2}
+COMPRESS = {1: lambda data: zlib.compress(data, 6), 2: lzma.compress}
+DECOMPRESS = {1: zlib.decompress, 2: lzma.decompress}
+COMPRESS_THRESHOLD = 4096
+TT_DTYPE = np.dtype('<i8')
+AMT_DTYPE = np.dtype('<f8')
+
+def encode_varints(values):
+    """LEB128 encoding of an array of unsigned 64 bit integers"""
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += values >= np.uint64(1 << (7*k))
+    offsets = np.cumsum(nbytes) - nbytes
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    for k in range(int(nbytes.max()) if len(values) else 0):
+        more = nbytes > k
+        chunk = (values[more] >> np.uint64(7*k)) & np.uint64(0x7f)
+        chunk |= np.where(nbytes[more] > k+1, np.uint64(0x80), np.uint64(0))
+        out[offsets[more] + k] = chunk
+    return out
+
+def decode_varints(data):
+    """Inverse of encode_varints for a buffer holding whole varints only"""
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    if not len(ends) or ends[-1] != len(data) - 1:
+        raise ValueError("Truncated varint")
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = 7*(np.arange(len(data)) - np.repeat(starts, ends - starts + 1))
+    return np.add.reduceat((data & 0x7f).astype(np.uint64) << shifts.astype(np.uint64), starts)
+
+def zigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+def unzigzag(values):
+    values = np.asarray(values, dtype=np.uint64)
+    return (values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64)
+
+def encode(chain, runs, tt, codec='none', threshold=COMPRESS_THRESHOLD):
+    """Encode the transactions of chain listed in runs, a list of (origin, indexes) with
+    the indexes of every run in local_time order, and the time table tt. Returns a
+    list of buffers to be sent as one frame"""
+    runs = [(origin, indexes) for origin, indexes in runs if len(indexes)]
+    origins = np.array([origin for origin, _ in runs], dtype=np.int64)
+    counts = np.array([len(indexes) for _, indexes in runs], dtype=np.int64)
+    indexes = np.concatenate([np.asarray(indexes, dtype=np.int64) for _, indexes in runs] + [np.zeros(0, dtype=np.int64)])
+    # gather straight from the arrays of the chain, only the selected rows are copied
+    local_time = np.frombuffer(chain.local_time, dtype=np.int64)[indexes]
+    dest = np.frombuffer(chain.dest, dtype=np.int32)[indexes].astype(np.int64)
+    amt = np.frombuffer(chain.amt, dtype=np.float64)[indexes].astype(AMT_DTYPE)
+    src = np.repeat(origins, counts)
+    deltas = np.diff(local_time, prepend=0)
+    # the first transaction of every run is relative to 0
+    run_starts = np.cumsum(counts) - counts
+    deltas[run_starts] = local_time[run_starts]
+    if (deltas < 0).any():
+        raise ValueError("Runs must be in local_time order")
+    columns = [np.array([len(runs)], dtype=np.uint64),
+               np.stack((origins, counts), axis=1).reshape(-1).view(np.uint64),
+               deltas.view(np.uint64), zigzag(dest - src)]
+    varints = encode_varints(np.concatenate(columns))
+    body = [varints.tobytes(), amt.tobytes(), np.ascontiguousarray(tt, dtype=TT_DTYPE).tobytes()]
+    codec_id = CODECS[codec]
+    if codec_id and sum(len(part) for part in body) >= threshold:
+        compressed = COMPRESS[codec_id](b''.join(body))
+        if len(compressed) < sum(len(part) for part in body):
+            body = [compressed]
+        else:
+            codec_id = 0
+    else:
+        codec_id = 0
+    header = HEADER.pack(MARKER, VERSION, codec_id, tt.shape[0], len(indexes), len(varints))
+    return [header] + body
+
+class Sync:
+    """A decoded sync message, every transaction field is a column"""
+    def __init__(self, origins, counts, src, dest, amt, local_time, tt):
+        self.origins = origins
+        self.counts = counts
+        self.src = src
+        self.dest = dest
+        self.amt = amt
+        self.local_time = local_time
+        self.tt = tt
+
+    def __len__(self):
+        return len(self.src)
+
+    def runs(self):
+        """(origin, first, count) of every run"""
+        first = 0
+        for origin, count in zip(self.origins, self.counts):
+            yield origin, first, count
+            first += count
+
+def decode(frame):
+    """Decode a frame built by encode. The columns and time table may be views into
+    frame, so they must be consumed before the buffer is reused"""
+    marker, version, codec_id, dimension, count, varint_size = HEADER.unpack_from(frame)
+    if marker != MARKER:
+        raise ValueError("Not a sync message")
+    if version != VERSION:
+        raise ValueError("Unsupported sync message version {}".format(version))
+    body = memoryview(frame)[HEADER.size:]
+    if codec_id:
+        if codec_id not in DECOMPRESS:
+            raise ValueError("Unknown sync compression {}".format(codec_id))
+        body = memoryview(DECOMPRESS[codec_id](body))
+    tt_size = dimension*dimension*TT_DTYPE.itemsize
+    if len(body) != varint_size + count*AMT_DTYPE.itemsize + tt_size:
+        raise ValueError("Sync message has the wrong size")
+    values = decode_varints(body[:varint_size])
+    if not len(values):
+        raise ValueError("Truncated sync message")
+    runs = int(values[0])
+    pairs = values[1:1+2*runs].astype(np.int64)
+    origins, counts = pairs[0::2], pairs[1::2]
+    if len(values) != 1 + 2*runs + 2*count or counts.sum() != count:
+        raise ValueError("Sync message has the wrong number of transactions")
+    columns = values[1+2*runs:]
+    deltas = columns[:count].view(np.int64)
+    src = np.repeat(origins, counts)
+    dest = src + unzigzag(columns[count:])
+    # cumulative sums restarted at the beginning of every run
+    total = np.cumsum(deltas)
+    run_starts = np.cumsum(counts) - counts
+    before = np.concatenate(([0], total))[run_starts]
+    local_time = total - np.repeat(before, counts)
+    amt = np.frombuffer(body, dtype=AMT_DTYPE, count=count, offset=varint_size)
+    tt = np.frombuffer(body, dtype=TT_DTYPE, count=dimension*dimension, offset=varint_size + count*AMT_DTYPE.itemsize).reshape(dimension, dimension)
+    return Sync(origins, counts, src, dest, amt, local_time, tt)
@@ -0,0 +1,173 @@
+"""
+Parallel verification of a hash-linked blockchain
+
+Recomputing the Merkle roots is the expensive part of verifying a chain, so the
+blocks are split into ranges of roughly equal numbers of transactions and each
+range is hashed in a worker process. Ledger files are memory-mapped by the
+workers themselves so transactions are never pickled. The cheap part, checking
+that every header links to the hash of the one before it, is stitched together
+in the calling process.
+
+Usage: python verify.py [LEDGER] [--workers N] [--threads]
+       python verify.py --bench TRANSACTIONS [--block-size B] [--max-workers N]
+"""
+
+import argparse
+import json
+import mmap
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from blocks import HEADER, GENESIS_HASH, BlockChain, merkle_root, sha256
+from block_store import BlockStore
+from chain import Chain, RECORD
+
+# transactions from which hashing them in a process pool beats doing it inline
+PARALLEL_VERIFY_THRESHOLD = 100000
+
+def merkle_roots(records, spans):
+    """Merkle roots of spans of RECORD encoded transactions, spans are (first, count)
+    in units of records from the start of the buffer"""
+    size = RECORD.size
+    roots = []
+    for first, count in spans:
+        leaves = [sha256(records[i*size:(i+1)*size]) for i in range(first, first+count)]
+        roots.append(merkle_root(leaves))
+    return roots
+
+def file_merkle_roots(path, spans):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return merkle_roots(mapped, spans)
+
+def split(headers, parts):
+    """Split the block headers into at most parts runs with similar numbers of transactions"""
+    total = sum(header[2] for header in headers)
+    target = max(1, total // parts)
+    runs, run, size = [], [], 0
+    for height, header in enumerate(headers):
+        run.append(height)
+        size += header[2]
+        if size >= target:
+            runs.append(run)
+            run, size = [], 0
+    if run:
+        runs.append(run)
+    return runs
+
+def check_links(headers, hashes):
+    """Height of the first header that does not link to the previous one, or None"""
+    prev_hash, expected_first = GENESIS_HASH, 0
+    for height, (block_height, first, count, block_prev, _) in enumerate(headers):
+        if block_height != height or block_prev != prev_hash or first != expected_first:
+            return height
+        prev_hash, expected_first = hashes[height], first + count
+    return None
+
+def verify_headers(raw_headers, submit, workers):
+    """Verify blocks given their packed headers. submit(spans) hashes the transactions
+    of the spans and returns a future of their roots. Returns the height of the first
+    bad block or None"""
+    headers = [HEADER.unpack(raw) for raw in raw_headers]
+    runs = split(headers, 4*workers)
+    futures = [submit([(headers[h][1], headers[h][2]) for h in run]) for run in runs]
+    bad = check_links(headers, [sha256(raw) for raw in raw_headers])
+    for run, future in zip(runs, futures):
+        for height, root in zip(run, future.result()):
+            if root != headers[height][4]:
+                bad = height if bad is None else min(bad, height)
+                break
+    return bad
+
+def make_executor(workers, threads=False):
+    return ThreadPoolExecutor(workers) if threads else ProcessPoolExecutor(workers)
+
+def verify_file(ledger_path, blocks_path, workers=None, threads=False):
+    """Verify a ledger written by block_store.BlockStore and blocks.BlockChain"""
+    workers = workers or os.cpu_count()
+    with open(blocks_path, 'rb') as f:
+        data = f.read()
+    raw_headers = [data[o:o+HEADER.size] for o in range(0, len(data) - len(data) % HEADER.size, HEADER.size)]
+    with make_executor(workers, threads) as executor:
+        return verify_headers(raw_headers, lambda spans: executor.submit(file_merkle_roots, ledger_path, spans), workers)
+
+def snapshot(blocks):
+    """Copy of the headers of a blocks.BlockChain and the RECORD encoded transactions
+    they cover, so they can be verified while the chain keeps growing"""
+    chain = blocks.chain
+    return list(blocks.headers), b''.join(chain.record(i) for i in range(blocks.sealed))
+
+def verify_records(raw_headers, records, workers=None, threads=False):
+    """Verify blocks given their packed headers and the transactions from the first
+    one on, as taken by snapshot. Returns the height of the first bad block or None"""
+    workers = workers or os.cpu_count()
+    size = RECORD.size
+    with make_executor(workers, threads) as executor:
+        def submit(spans):
+            # ship only the transactions of these spans, renumbered from 0
+            parts, local, offset = [], [], 0
+            for first, count in spans:
+                parts.append(records[first*size:(first+count)*size])
+                local.append((offset, count))
+                offset += count
+            return executor.submit(merkle_roots, b''.join(parts), local)
+        return verify_headers(raw_headers, submit, workers)
+
+def verify_blockchain(blocks, workers=None, threads=False):
+    """Verify an in-memory blocks.BlockChain, for example one received from a peer"""
+    headers, records = snapshot(blocks)
+    bad = verify_records(headers, records, workers, threads)
+    blocks.verified = len(headers) if bad is None else bad
+    return bad is None
+
+def write_synthetic(directory, transactions, block_size):
+    path = os.path.join(directory, 'bench.dat')
+    store = BlockStore(path)
+    chain = Chain()
+    blocks = BlockChain(chain, path + '.blocks')
+    for i in range(transactions):
+        index = chain.append({'type': 'TRA', 'src': 8000 + i % 7, 'dest': 8000 + i % 5, 'amt': 1.0, 'local_time': i})
+        store.append(chain, index)
+        if len(chain) - blocks.sealed == block_size:
+            blocks.seal()
+    blocks.seal()
+    store.close()
+    blocks.close()
+    return path
+
+def bench(transactions, block_size, max_workers):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_synthetic(directory, transactions, block_size)
+        workers = 1
+        while True:
+            start = time.perf_counter()
+            bad = verify_file(path, path + '.blocks', workers)
+            elapsed = time.perf_counter() - start
+            results.append({'workers': workers, 'elapsed_s': elapsed, 'valid': bad is None})
+            if workers >= max_workers:
+                break
+            workers = min(2*workers, max_workers)
+    for result in results:
+        result['speedup'] = results[0]['elapsed_s'] / result['elapsed_s']
+    return {'transactions': transactions, 'block_size': block_size, 'runs': results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify a blockchain in parallel")
+    parser.add_argument('ledger', nargs='?', default='ledger.dat')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threads', action='store_true', help="use threads instead of processes")
+    parser.add_argument('--bench', type=int, metavar='TRANSACTIONS', help="time verification of a synthetic chain with 1..cpu_count workers")
+    parser.add_argument('--block-size', type=int, default=1000)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count(), help="largest pool size tried by --bench")
+    args = parser.parse_args()
+    if args.bench:
+        print(json.dumps(bench(args.bench, args.block_size, args.max_workers), indent=2))
+    else:
+        bad = verify_file(args.ledger, args.ledger + '.blocks', args.workers, args.threads)
+        if bad is None:
+            print("{} verified".format(args.ledger))
+        else:
+            print("{} failed verification at block {}".format(args.ledger, bad))
+            raise SystemExit(1)